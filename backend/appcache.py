@@ -0,0 +1,61 @@
+"""
+Caches the plugin's view of heedy apps (their owner, plugin and settings), so that validating requests and
+scheduling syncs don't need a round trip to heedy. The cache is kept up to date by heedy's app events, which
+the plugin receives through its hooks, and entries expire after a TTL in case an event was missed.
+"""
+
+from heedy import App, Plugin
+import logging
+import time
+
+
+class AppCache:
+    def __init__(self, p: Plugin, ttl: float = 60 * 60):
+        self.p = p
+        self.ttl = ttl
+        self.l = logging.getLogger("cgm.apps")
+        self.apps = {}
+        self.fetched = {}
+        # The time at which the list of CGM apps was last loaded from heedy
+        self.listed = None
+
+    def is_cgm(self, app: App) -> bool:
+        return app["plugin"] == f"{self.p.name}:cgm"
+
+    def put(self, app: App):
+        self.apps[app["id"]] = app
+        self.fetched[app["id"]] = time.time()
+
+    def invalidate(self, appid: str):
+        self.apps.pop(appid, None)
+        self.fetched.pop(appid, None)
+
+    async def get(self, appid: str, refresh: bool = False) -> App:
+        """
+        Returns the app with the given id, reading it from heedy if it isn't cached, its entry expired,
+        or refresh is set. Raises an exception if the app doesn't exist.
+        """
+        if (
+            refresh
+            or appid not in self.apps
+            or time.time() - self.fetched[appid] > self.ttl
+        ):
+            self.put(await self.p.apps[appid])
+        return self.apps[appid]
+
+    async def all(self) -> list:
+        """
+        Returns all CGM apps, listing them from heedy once the list is older than the TTL
+        """
+        if self.listed is None or time.time() - self.listed > self.ttl:
+            applist = await self.p.apps(plugin=f"{self.p.name}:cgm")
+            self.listed = time.time()
+            appids = set()
+            for app in applist:
+                appids.add(app["id"])
+                self.put(app)
+            for appid, app in list(self.apps.items()):
+                if self.is_cgm(app) and appid not in appids:
+                    self.l.debug("App %s no longer exists", appid)
+                    self.invalidate(appid)
+        return [app for app in self.apps.values() if self.is_cgm(app)]
@@ -0,0 +1,232 @@
+"""
+Writes datapoints to heedy timeseries in batches whose size adapts to how fast heedy accepts them. Batches are
+capped by their number of datapoints and by their size in bytes, and are grown or shrunk so that each insert takes
+about the target latency. A bounded number of inserts run at once, and adding data to a writer that has that many
+inserts running waits for the oldest to finish, which holds back whatever is reading the data when heedy slows down.
+
+BatchWriter is used with sync heedy sessions (in import processes), with inserts running in threads, and
+AsyncBatchWriter with async sessions (in the main process), with inserts running as tasks.
+"""
+
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urljoin
+from heedy import Timeseries
+from heedy.base import AsyncSession
+import asyncio
+import json
+import time
+
+import metrics
+
+# Batches are only resized based on inserts holding at least this fraction of the batch size, since the
+# per-request overhead makes smaller inserts look slow
+FULL_BATCH = 0.5
+
+
+def insert_json(ts: Timeseries, data: str, **kwargs):
+    """
+    Equivalent to ts.insert_array, but takes an already JSON-encoded datapoint array.
+    Works with both sync and async sessions (returning an awaitable for async sessions).
+    """
+    s = ts.session
+    path = ts.uri + "/timeseries"
+    if isinstance(s, AsyncSession):
+        return insert_json_async(s, path, data, kwargs)
+    return s.handleResponse(
+        s.s.post(urljoin(s.url, path), data=data.encode(), params=kwargs)
+    ).json()
+
+
+async def insert_json_async(s: AsyncSession, path: str, data: str, params: dict):
+    r = await s.raw("POST", path, data=data.encode(), params=params)
+    return await (await s.handleResponse(r)).json()
+
+
+class BatchSizer:
+    def __init__(self, config: dict):
+        self.max_points = config.get("insert_batch_points", 100000)
+        self.max_bytes = config.get("insert_batch_bytes", 4 * 1024 * 1024)
+        self.target_latency = config.get("insert_target_latency", 1)
+        self.min_points = min(100, self.max_points)
+        self.points = min(10000, self.max_points)
+        # Estimated from the inserts so far, assuming compact JSON datapoints to start with
+        self.bytes_per_point = 40
+
+    def size(self) -> int:
+        """
+        Returns the number of datapoints to put in the next batch
+        """
+        return max(
+            min(self.points, int(self.max_bytes / self.bytes_per_point)),
+            self.min_points,
+        )
+
+    def observe(self, points: int, size: int, duration: float):
+        if points == 0:
+            return
+        self.bytes_per_point = size / points
+        if points < self.points * FULL_BATCH or duration <= 0:
+            return
+        # Aim for the target latency at the observed rate, changing by at most a factor of 2 at once
+        ideal = points / duration * self.target_latency
+        self.points = int(min(max(ideal, self.points / 2), self.points * 2))
+        self.points = min(max(self.points, self.min_points), self.max_points)
+
+
+class BatchWriterBase:
+    def __init__(self, source: str, config: dict):
+        self.source = source
+        self.sizer = BatchSizer(config)
+        self.in_flight = config.get("insert_writes_in_flight", 2)
+        # Datapoints waiting to fill a batch, by timeseries
+        self.buffers = {}
+        # Running inserts and callbacks, in the order they were added
+        self.pending = deque()
+
+    def size(self) -> int:
+        return self.sizer.size()
+
+    def encode(self, points: list) -> str:
+        return json.dumps([{"t": t, "d": d} for t, d in points])
+
+    def full_batches(self, ts: Timeseries, points: list):
+        # Adds the (timestamp, value) points to the timeseries' buffer, returning the batches that are full
+        if ts.uri not in self.buffers:
+            self.buffers[ts.uri] = (ts, [])
+        buffer = self.buffers[ts.uri][1]
+        buffer.extend(points)
+        batches = []
+        while len(buffer) >= self.size():
+            n = self.size()
+            batches.append(buffer[:n])
+            del buffer[:n]
+        return batches
+
+    def remaining_batches(self):
+        # Empties all buffers, returning their contents as (timeseries, points)
+        batches = [
+            (ts, buffer) for ts, buffer in self.buffers.values() if len(buffer) > 0
+        ]
+        self.buffers = {}
+        return batches
+
+
+class BatchWriter(BatchWriterBase):
+    """
+    Writes datapoints to timeseries of a sync heedy session in adaptively sized batches, running up to
+    insert_writes_in_flight inserts at once in threads. Callbacks given to after run in the calling thread,
+    in order, once everything added before them was written. Errors of inserts are raised by later calls.
+    """
+
+    def __init__(self, source: str, config: dict):
+        super().__init__(source, config)
+        self.executor = ThreadPoolExecutor(self.in_flight)
+
+    def insert(self, ts: Timeseries, data: str, count: int):
+        start = time.perf_counter()
+        key = ts["key"]
+        with metrics.insert_duration.time(object=key, source=self.source):
+            result = insert_json(ts, data)
+        self.sizer.observe(count, len(data), time.perf_counter() - start)
+        metrics.points_inserted.inc(count, object=key, source=self.source)
+        return result
+
+    def wait(self, limit: int):
+        # Finishes the oldest inserts and callbacks until at most limit inserts are running
+        while sum(1 for f, _ in self.pending if f is not None) > limit or (
+            len(self.pending) > 0 and self.pending[0][0] is None
+        ):
+            future, done = self.pending.popleft()
+            if future is not None:
+                future.result()
+            if done is not None:
+                done()
+
+    def write_json(self, ts: Timeseries, data: str, count: int):
+        """
+        Writes an already JSON-encoded datapoint array, which is not resized
+        """
+        self.wait(self.in_flight - 1)
+        self.pending.append((self.executor.submit(self.insert, ts, data, count), None))
+
+    def add(self, ts: Timeseries, points: list):
+        """
+        Adds (timestamp, value) datapoints to be written to the timeseries
+        """
+        for batch in self.full_batches(ts, points):
+            self.write_json(ts, self.encode(batch), len(batch))
+
+    def after(self, done: Callable):
+        """
+        Writes the datapoints added so far, and calls done once they (and everything before them) are written
+        """
+        for ts, batch in self.remaining_batches():
+            self.write_json(ts, self.encode(batch), len(batch))
+        self.pending.append((None, done))
+        self.wait(self.in_flight)
+
+    def flush(self):
+        """
+        Writes the datapoints added so far, and waits for all inserts to finish
+        """
+        self.after(None)
+        self.wait(0)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class AsyncBatchWriter(BatchWriterBase):
+    """
+    Writes datapoints to timeseries of an async heedy session in adaptively sized batches, running up to
+    insert_writes_in_flight inserts at once as tasks. Callbacks given to after can be coroutine functions.
+    Errors of inserts are raised by later calls.
+    """
+
+    async def insert(self, ts: Timeseries, data: str, count: int):
+        start = time.perf_counter()
+        key = ts["key"]
+        with metrics.insert_duration.time(object=key, source=self.source):
+            result = await insert_json(ts, data)
+        self.sizer.observe(count, len(data), time.perf_counter() - start)
+        metrics.points_inserted.inc(count, object=key, source=self.source)
+        return result
+
+    async def wait(self, limit: int):
+        while sum(1 for t, _ in self.pending if t is not None) > limit or (
+            len(self.pending) > 0 and self.pending[0][0] is None
+        ):
+            task, done = self.pending.popleft()
+            if task is not None:
+                await task
+            if done is not None:
+                result = done()
+                if asyncio.iscoroutine(result):
+                    await result
+
+    async def write_json(self, ts: Timeseries, data: str, count: int):
+        await self.wait(self.in_flight - 1)
+        task = asyncio.create_task(self.insert(ts, data, count))
+        self.pending.append((task, None))
+
+    async def add(self, ts: Timeseries, points: list):
+        for batch in self.full_batches(ts, points):
+            await self.write_json(ts, self.encode(batch), len(batch))
+
+    async def after(self, done: Callable):
+        for ts, batch in self.remaining_batches():
+            await self.write_json(ts, self.encode(batch), len(batch))
+        self.pending.append((None, done))
+        await self.wait(self.in_flight)
+
+    async def flush(self):
+        await self.after(None)
+        await self.wait(0)
+
+    def close(self):
+        for task, _ in self.pending:
+            if task is not None:
+                task.cancel()
+        self.pending.clear()
@@ -0,0 +1,132 @@
+"""
+Encodes an app's timeseries for bulk export, reading them in bounded batches so that exports of any length
+use constant memory. Each format is a stream of rows holding the object key, timestamp and value:
+
+- csv: a header line, followed by object,t,d rows
+- ndjson: one {"object","t","d"} JSON object per line
+- binary: the magic bytes CGM1, followed by blocks that each hold a little-endian uint16 key length, the
+  utf-8 key, a uint32 count, then count int64 millisecond timestamps followed by count float32 values.
+  Only numeric timeseries can be exported this way.
+
+Zipped exports hold one file per object, named {key}.{format}, each in the same format.
+"""
+
+from heedy import Timeseries
+import array
+import csv
+import io
+import json
+import struct
+import sys
+
+# The timeseries that can be exported
+EXPORT_OBJECTS = ["cgm", "blood_test", "events"]
+NUMERIC_OBJECTS = ["cgm", "blood_test"]
+
+# The number of datapoints read from heedy at once
+BATCH_SIZE = 10000
+
+
+def encode_csv(key: str, data: list) -> bytes:
+    out = io.StringIO()
+    w = csv.writer(out, lineterminator="\n")
+    w.writerows((key, dp["t"], dp["d"]) for dp in data)
+    return out.getvalue().encode()
+
+
+def encode_ndjson(key: str, data: list) -> bytes:
+    return "".join(
+        json.dumps({"object": key, "t": dp["t"], "d": dp["d"]}) + "\n" for dp in data
+    ).encode()
+
+
+def encode_binary(key: str, data: list) -> bytes:
+    k = key.encode()
+    t = array.array("q", (round(dp["t"] * 1000) for dp in data))
+    d = array.array("f", (dp["d"] for dp in data))
+    if sys.byteorder != "little":
+        t.byteswap()
+        d.byteswap()
+    return (
+        struct.pack("<H", len(k))
+        + k
+        + struct.pack("<I", len(data))
+        + t.tobytes()
+        + d.tobytes()
+    )
+
+
+# The content type, header and batch encoder of each format
+FORMATS = {
+    "csv": ("text/csv", b"object,t,d\n", encode_csv),
+    "ndjson": ("application/x-ndjson", b"", encode_ndjson),
+    "binary": ("application/octet-stream", b"CGM1", encode_binary),
+}
+
+
+async def batches(ts: Timeseries, t1: float = None, t2: float = None):
+    # Pages through the timeseries by timestamp. Timestamps are unique, and t1 is inclusive,
+    # so each page after the first starts by repeating the last datapoint of the previous one.
+    query = {"limit": BATCH_SIZE + 1}
+    if t1 is not None:
+        query["t1"] = t1
+    if t2 is not None:
+        query["t2"] = t2
+    last = None
+    while True:
+        if last is not None:
+            query["t1"] = last
+        data = await ts(**query)
+        if last is not None:
+            data = [dp for dp in data if dp["t"] > last]
+        if len(data) == 0:
+            return
+        yield data
+        last = data[-1]["t"]
+
+
+class ZipOutput:
+    # A write-only file for zipfile, whose written bytes are taken out as they are produced.
+    # It has no tell, so zipfile writes a streamable zip.
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, b) -> int:
+        self.buffer += b
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        b = bytes(self.buffer)
+        self.buffer.clear()
+        return b
+
+
+async def export_chunks(
+    objects: list, fmt: str, t1: float = None, t2: float = None, zipped: bool = False
+):
+    """
+    Yields the encoded export of the given (key, timeseries) pairs in chunks of bytes, one for each batch.
+    """
+    _, header, encode = FORMATS[fmt]
+    if not zipped:
+        yield header
+        for key, ts in objects:
+            async for data in batches(ts, t1, t2):
+                yield encode(key, data)
+        return
+
+    # zipfile is only loaded for zipped exports
+    import zipfile
+
+    out = ZipOutput()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for key, ts in objects:
+            with z.open(f"{key}.{fmt}", "w", force_zip64=True) as f:
+                f.write(header)
+                async for data in batches(ts, t1, t2):
+                    f.write(encode(key, data))
+                    yield out.take()
+    yield out.take()
@@ -1,42 +1,167 @@
-from multiprocessing import Process, Queue
+from typing import Callable
+from multiprocessing import Array, Process, Queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from heedy import Plugin, App
-from asyncio import Lock
-from .xdrip import xdrip_import
+from .dedup import is_imported, record_import
+import importlib
+import asyncio
+import json
 import logging
+import queue
+import time
+import uuid
 import os
 
+import metrics
+
+
+class ImportCancelled(Exception):
+    pass
+
 
 class Importer:
-    importers = {"xdrip": xdrip_import}
+    # The module and function of each importer. Importers are only loaded once a job needs them, so that
+    # starting the plugin doesn't load every import format.
+    importers = {
+        "xdrip": ".xdrip:xdrip_import",
+        "clarity": ".clarity:clarity_import",
+        "libreview": ".libreview:libreview_import",
+    }
     log = logging.getLogger("cgm.importer")
 
-    def __init__(self, p: Plugin, max_process_count: int = 2):
+    # Finished jobs are kept this many seconds so that their status can still be queried
+    keep_finished = 60 * 60
+    # Number of times a job is restarted after its worker process died
+    max_attempts = 3
+
+    def __init__(self, p: Plugin, num_processes: int = 1):
         self.p = p
-        self.processes = []
-        self.queue = Queue()
-        self.max_process_count = max_process_count
-
-    def process_count(self) -> int:
-        proc = []
-        for p in self.processes:
-            if p.is_alive():
-                proc.append(p)
-        self.processes = proc
-        return len(self.processes)
+        # The plugin's configuration (from heedy.conf), which is passed to each importer
+        self.config = p.config["config"]["plugin"][p.name]["config"]
+        self.num_processes = num_processes
+        self.processes = [None] * num_processes
+
+        # The status of each job, by job id
+        self.jobs = {}
+        # Jobs waiting for a free worker are queued per app, and apps take turns, so that one
+        # user's large imports don't hold back everyone else's
+        self.waiting = {}
+        self.turns = deque()
+        # The job running on each worker
+        self.running = [None] * num_processes
+
+        # Each worker has its own queue, to which a job is sent only when the worker is free. Workers report
+        # back on the status queue. The cancel array holds the number of the job to cancel on each worker.
+        self.queues = [Queue() for i in range(num_processes)]
+        self.status = Queue()
+        self.cancel_jobs = Array("q", num_processes, lock=False)
+        self.job_number = 0
+
+        # Uploads up to this many bytes are imported in threads of the main process, without waiting
+        # for a worker, since handing them to a worker costs more than importing them
+        self.inprocess_size = self.config.get("import_inprocess_size", 1024 * 1024)
+        self.executor = ThreadPoolExecutor(2)
+        self.inprocess = set()
+        self.cancelled = set()
+        # The sync heedy session used by imports in the main process, created on first use
+        self.sync_plugin = None
+
+        # Uploaded files are kept in the spool folder (in the plugin's data directory) until their job
+        # finishes, along with a file describing each job, and a file holding each job's checkpoints
+        self.spool_dir = os.path.abspath("import_spool")
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        metrics.collectors.append(self.collect)
 
     def start(self):
-        pc = self.process_count()
-        if pc < self.max_process_count and self.queue.qsize() > 0:
-            p = Process(target=self.run)
-            self.processes.append(p)
-            p.daemon = True
-            p.start()
-
-    async def upload(self, app: App, data_type: str, **kwargs):
+        """
+        Starts the worker processes, and the task that follows their progress, and resumes the jobs that were
+        interrupted by the plugin stopping. Must be called from within the event loop, before anything starts
+        threads, since forking a process with running threads can deadlock the worker.
+        """
+        for i in range(self.num_processes):
+            self.start_worker(i)
+        asyncio.create_task(self.follow())
+        self.resume()
+
+    def importer(self, data_type: str) -> Callable:
+        module, name = self.importers[data_type].split(":")
+        return getattr(importlib.import_module(module, __package__), name)
+
+    def job_file(self, jobid: str) -> str:
+        return os.path.join(self.spool_dir, jobid + ".job.json")
+
+    def checkpoint_file(self, jobid: str) -> str:
+        return os.path.join(self.spool_dir, jobid + ".checkpoint.json")
+
+    def resume(self):
+        jobs = []
+        for f in os.listdir(self.spool_dir):
+            if f.endswith(".job.json"):
+                with open(os.path.join(self.spool_dir, f), "r") as jf:
+                    jobs.append(json.load(jf))
+
+        # Remove files left behind by anything other than the jobs being resumed, such as uploads
+        # that never got a job because the plugin stopped while they were being received
+        used = set()
+        for job in jobs:
+            used.add(os.path.basename(job["args"]["tmpfile"]))
+            used.add(os.path.basename(self.job_file(job["id"])))
+            used.add(os.path.basename(self.checkpoint_file(job["id"])))
+        for f in os.listdir(self.spool_dir):
+            if f not in used:
+                os.remove(os.path.join(self.spool_dir, f))
+
+        for job in sorted(jobs, key=lambda j: j["created"]):
+            if not os.path.exists(job["args"]["tmpfile"]):
+                # The job finished, but the plugin stopped before it was cleaned up
+                os.remove(self.job_file(job["id"]))
+                continue
+            self.log.info("Resuming import job %s (%s)", job["id"], job["filename"])
+            self.queue_job(**job)
+
+    def start_worker(self, i: int):
+        p = Process(target=self.run, args=(i,))
+        p.daemon = True
+        p.start()
+        self.processes[i] = p
+
+    async def upload(
+        self, app: App, data_type: str, sha256: str = None, **kwargs
+    ) -> str:
+        """
+        Queues the uploaded file for import, returning the import job's id. If sha256 (the hash of the file's
+        contents) is given, and the same file was already imported, the import is skipped and None is returned.
+        If the same file is already being imported, the id of that job is returned instead.
+        """
         self.log.debug("App %s import %s %s", app["id"], data_type, kwargs)
         if not data_type in self.importers:
             raise Exception("Data type not found")
 
+        jobid = self.pending_import(
+            app["id"], sha256, data_type, kwargs.get("overwrite", False)
+        )
+        if jobid is not None:
+            self.log.debug("App %s is already importing %s", app["id"], sha256)
+            os.remove(kwargs["tmpfile"])
+            return jobid
+
+        if sha256 is not None and await is_imported(
+            app, sha256, data_type, kwargs.get("overwrite", False)
+        ):
+            self.log.debug("App %s already imported %s", app["id"], sha256)
+            os.remove(kwargs["tmpfile"])
+            await app.notify(
+                "importer",
+                f"{kwargs['filename']} was already imported - there is nothing new to import ({data_type})",
+                description="",
+                type="success",
+                seen=False,
+                _global=True,
+            )
+            return None
+
         await app.notify(
             "importer",
             f"{kwargs['filename']} queued for Import ({data_type})",
@@ -44,24 +169,388 @@ class Importer:
             type="info",
         )
 
-        self.queue.put((app["id"], data_type, kwargs))
-        self.start()
+        self.prune()
+        job = {
+            "id": uuid.uuid4().hex,
+            "app": app["id"],
+            "data_type": data_type,
+            "filename": kwargs["filename"],
+            "created": time.time(),
+            "sha256": sha256,
+            "args": kwargs,
+        }
+        with open(self.job_file(job["id"]), "w") as f:
+            json.dump(job, f)
+        self.queue_job(**job)
+        return job["id"]
+
+    def pending_import(
+        self, appid: str, sha256: str, data_type: str, overwrite: bool
+    ) -> str:
+        # Returns the id of a queued or running job that imports the same file the same way, if any
+        if sha256 is None:
+            return None
+        for job in self.jobs.values():
+            if (
+                job["app"] == appid
+                and job["sha256"] == sha256
+                and job["data_type"] == data_type
+                and job["status"] in ["queued", "running"]
+                and (job["args"].get("overwrite", False) or not overwrite)
+            ):
+                return job["id"]
+        return None
+
+    def queue_job(self, id, app, data_type, filename, created, sha256, args):
+        self.job_number += 1
+        self.jobs[id] = {
+            "id": id,
+            "app": app,
+            "data_type": data_type,
+            "filename": filename,
+            "status": "queued",
+            "rows": 0,
+            "total": None,
+            "percent": None,
+            "rows_per_second": None,
+            "created": created,
+            "started": None,
+            "finished": None,
+            "error": None,
+            "sha256": sha256,
+            "attempts": 0,
+            "number": self.job_number,
+            "args": args,
+        }
+        if os.path.getsize(args["tmpfile"]) <= self.inprocess_size:
+            self.run_inprocess(id)
+            return
+        if app not in self.waiting:
+            self.waiting[app] = deque()
+            self.turns.append(app)
+        self.waiting[app].append(id)
+        self.dispatch()
+
+    def run_inprocess(self, jobid: str):
+        # The job stays queued until one of the executor's threads picks it up
+        job = self.jobs[jobid]
+        job["attempts"] += 1
+        self.inprocess.add(jobid)
+        if self.sync_plugin is None:
+            self.sync_plugin = Plugin(config=self.p.config, session="sync")
+
+        # The job reports back to the event loop, like workers do through the status queue
+        loop = asyncio.get_running_loop()
+
+        def run():
+            if jobid in self.cancelled:
+                # The job was cancelled while it was queued
+                loop.call_soon_threadsafe(self.cancelled.discard, jobid)
+                return
+            loop.call_soon_threadsafe(self.inprocess_started, jobid)
+            self.run_job(
+                self.sync_plugin,
+                jobid,
+                job["app"],
+                job["data_type"],
+                job["args"],
+                lambda msg: loop.call_soon_threadsafe(self.update, msg),
+                lambda: jobid in self.cancelled,
+            )
+
+        future = loop.run_in_executor(self.executor, run)
+        future.add_done_callback(lambda f: self.inprocess_done(jobid, f))
+
+    def inprocess_started(self, jobid: str):
+        job = self.jobs.get(jobid)
+        if job is not None and job["status"] == "queued":
+            job["status"] = "running"
+            job["started"] = time.time()
+
+    def inprocess_done(self, jobid: str, future: asyncio.Future):
+        # run_job reports how the import went, so this only catches errors outside of the import itself,
+        # such as failing to send a notification. Jobs that already finished are left as they are.
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        self.log.error(f"Import job {jobid} failed: {e}")
+        job = self.jobs.get(jobid)
+        if job is None:
+            return
+        if job["status"] == "running":
+            self.update((jobid, "failed", str(e)))
+        if os.path.exists(job["args"]["tmpfile"]):
+            os.remove(job["args"]["tmpfile"])
+
+    def job(self, jobid: str) -> dict:
+        """
+        Returns the public status of the given job
+        """
+        return {
+            k: v
+            for k, v in self.jobs[jobid].items()
+            if k not in ["args", "number", "attempts"]
+        }
+
+    def cancel(self, jobid: str):
+        job = self.jobs[jobid]
+        if job["status"] == "queued" and jobid in self.inprocess:
+            self.finish(jobid, "cancelled")
+            os.remove(job["args"]["tmpfile"])
+            # Tells the executor thread not to start the job
+            self.cancelled.add(jobid)
+        elif job["status"] == "queued":
+            self.waiting[job["app"]].remove(jobid)
+            if len(self.waiting[job["app"]]) == 0:
+                del self.waiting[job["app"]]
+                self.turns.remove(job["app"])
+            self.finish(jobid, "cancelled")
+            os.remove(job["args"]["tmpfile"])
+        elif job["status"] == "running" and jobid in self.inprocess:
+            self.cancelled.add(jobid)
+        elif job["status"] == "running":
+            self.cancel_jobs[self.running.index(jobid)] = job["number"]
+
+    def prune(self):
+        old = time.time() - self.keep_finished
+        for jobid in list(self.jobs):
+            finished = self.jobs[jobid]["finished"]
+            if finished is not None and finished < old:
+                del self.jobs[jobid]
+
+    def dispatch(self):
+        # Give each free worker the next job, with apps taking turns
+        while None in self.running and len(self.turns) > 0:
+            appid = self.turns.popleft()
+            jobid = self.waiting[appid].popleft()
+            if len(self.waiting[appid]) > 0:
+                self.turns.append(appid)
+            else:
+                del self.waiting[appid]
+
+            job = self.jobs[jobid]
+            job["status"] = "running"
+            job["started"] = time.time()
+            job["attempts"] += 1
+            i = self.running.index(None)
+            self.running[i] = jobid
+            self.queues[i].put(
+                (jobid, job["number"], appid, job["data_type"], job["args"])
+            )
+
+    def finish(self, jobid: str, status: str, error: str = None):
+        job = self.jobs[jobid]
+        job["status"] = status
+        job["error"] = error
+        job["finished"] = time.time()
+        if jobid in self.running:
+            self.running[self.running.index(jobid)] = None
+        self.inprocess.discard(jobid)
+        self.cancelled.discard(jobid)
+        for f in [self.job_file(jobid), self.checkpoint_file(jobid)]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def update(self, msg):
+        jobid, status, value = msg
+        if status == "metric":
+            metrics.apply(*value)
+            return
+        if jobid not in self.jobs:
+            return
+        job = self.jobs[jobid]
+        if status == "progress":
+            job["rows"], job["total"] = value
+            if job["total"]:
+                job["percent"] = 100 * min(job["rows"] / job["total"], 1)
+            elapsed = time.time() - job["started"]
+            if elapsed > 0:
+                job["rows_per_second"] = job["rows"] / elapsed
+        else:
+            self.finish(jobid, status, value)
+            self.dispatch()
+            metrics.import_job_duration.observe(
+                job["finished"] - job["started"],
+                data_type=job["data_type"],
+                status=status,
+            )
+            if status == "done":
+                metrics.import_last_success.set(job["finished"], app=job["app"])
+            if status == "done" and job["sha256"] is not None:
+                asyncio.create_task(self.record(job))
+
+    async def record(self, job: dict):
+        # Remembers the imported file, so that uploading it again can be skipped
+        try:
+            app = await self.p.apps[job["app"]]
+            await record_import(
+                app,
+                job["sha256"],
+                job["data_type"],
+                job["args"].get("overwrite", False),
+            )
+        except Exception as e:
+            self.log.error(f"Failed to record import of {job['sha256']}: {e}")
+
+    def collect(self):
+        yield (
+            "cgm_import_queue_depth",
+            "gauge",
+            "Number of import jobs waiting for a worker",
+            [
+                (
+                    {},
+                    sum(len(w) for w in self.waiting.values())
+                    + sum(
+                        1 for j in self.inprocess if self.jobs[j]["status"] == "queued"
+                    ),
+                )
+            ],
+        )
+        yield (
+            "cgm_import_jobs_running",
+            "gauge",
+            "Number of import jobs being run by workers",
+            [
+                (
+                    {},
+                    sum(1 for jobid in self.running if jobid is not None)
+                    + sum(
+                        1 for j in self.inprocess if self.jobs[j]["status"] == "running"
+                    ),
+                )
+            ],
+        )
+
+    def check_workers(self):
+        # If a worker process died, its job is put back in the queue to resume from its last checkpoint,
+        # unless it already used up its attempts, and the worker is replaced
+        for i, p in enumerate(self.processes):
+            if not p.is_alive():
+                self.log.error("Import worker %d died - restarting", i)
+                jobid = self.running[i]
+                if jobid is not None:
+                    self.running[i] = None
+                    job = self.jobs[jobid]
+                    if job["attempts"] >= self.max_attempts:
+                        self.finish(jobid, "failed", "The import process died")
+                        os.remove(job["args"]["tmpfile"])
+                    else:
+                        job["status"] = "queued"
+                        if job["app"] not in self.waiting:
+                            self.waiting[job["app"]] = deque()
+                            self.turns.appendleft(job["app"])
+                        self.waiting[job["app"]].appendleft(jobid)
+                self.start_worker(i)
+        self.dispatch()
 
-    def run(self):
-        self.log.debug("Started import process")
+    async def follow(self):
+        # Workers are checked every few seconds, even while they keep sending messages
+        loop = asyncio.get_running_loop()
+        checked = time.monotonic()
+        while True:
+            try:
+                msg = await loop.run_in_executor(None, self.status.get, True, 5)
+            except queue.Empty:
+                pass
+            else:
+                try:
+                    self.update(msg)
+                except Exception as e:
+                    self.log.exception(f"Failed to process import status {msg}: {e}")
+            if time.monotonic() - checked >= 5:
+                checked = time.monotonic()
+                try:
+                    self.check_workers()
+                except Exception as e:
+                    self.log.exception(f"Failed to check import workers: {e}")
+
+    def run(self, worker: int):
+        self.log.debug("Started import process %d", worker)
         p = Plugin(config=self.p.config, session="sync")
 
-        while self.queue.qsize() > 0:
-            app_id, data_type, kwargs = self.queue.get()
-            l = self.log.getChild(app_id + "." + data_type)
-            l.debug("Importing %s", kwargs)
+        # Metrics recorded by importers are sent to the main process, which serves them
+        metrics.enabled = self.config.get("metrics", True)
+        metrics.sink = lambda *args: self.status.put((None, "metric", args))
+
+        while True:
+            jobid, number, app_id, data_type, kwargs = self.queues[worker].get()
+            self.run_job(
+                p,
+                jobid,
+                app_id,
+                data_type,
+                kwargs,
+                self.status.put,
+                lambda: self.cancel_jobs[worker] == number,
+            )
+
+    def run_job(
+        self,
+        p: Plugin,
+        jobid: str,
+        app_id: str,
+        data_type: str,
+        kwargs: dict,
+        report: Callable,
+        cancelled: Callable,
+    ):
+        """
+        Runs an import job with a sync heedy session, either in a worker process or in a thread of the main
+        process. Progress and the result are sent to report, and cancelled tells whether the job was cancelled.
+        """
+        l = self.log.getChild(app_id + "." + data_type)
+        l.debug("Importing %s", kwargs)
+        app = None
+
+        def progress(rows: int, total: int = None):
+            # Called by importers after each batch. Raises ImportCancelled if the job was cancelled.
+            if cancelled():
+                raise ImportCancelled()
+            report((jobid, "progress", (rows, total)))
+
+        # Importers call checkpoint with the timestamp up to which each timeseries was written,
+        # which lets an interrupted import continue where it left off
+        checkpoints = {}
+        if os.path.exists(self.checkpoint_file(jobid)):
+            with open(self.checkpoint_file(jobid), "r") as f:
+                checkpoints = json.load(f)
+            l.debug("Resuming from checkpoints %s", checkpoints)
+
+        def checkpoint(key: str, t: float):
+            checkpoints[key] = t
+            with open(self.checkpoint_file(jobid) + ".tmp", "w") as f:
+                json.dump(checkpoints, f)
+            os.replace(
+                self.checkpoint_file(jobid) + ".tmp", self.checkpoint_file(jobid)
+            )
+
+        try:
             app = p.apps[app_id]
             app.notify("importer", f"Importing {kwargs['filename']} ({data_type})...")
-
-            try:
-                self.importers[data_type](app, l, **kwargs)
-            except Exception as e:
-                self.log.error(e)
+            self.importer(data_type)(
+                app,
+                l,
+                progress=progress,
+                checkpoints=dict(checkpoints),
+                checkpoint=checkpoint,
+                config=self.config,
+                **kwargs,
+            )
+        except ImportCancelled:
+            l.debug("Import cancelled")
+            report((jobid, "cancelled", None))
+            app.notify(
+                "importer",
+                f"Import of {kwargs['filename']} was cancelled ({data_type})",
+                description="",
+                type="warning",
+                seen=False,
+            )
+        except Exception as e:
+            self.log.error(e)
+            report((jobid, "failed", str(e)))
+            if app is not None:
                 app.notify(
                     "importer",
                     f"Failed to upload {kwargs['filename']} ({data_type})",
@@ -72,16 +561,15 @@ class Importer:
                         "seen": False,
                     },
                 )
-            else:
-                app.notify(
-                    "importer",
-                    f"{kwargs['filename']} imported successfully ({data_type})",
-                    description="",
-                    type="success",
-                    seen=False,
-                    _global=True,
-                )
-            # After import is done, delete the temp file
-            os.remove(kwargs["tmpfile"])
-
-        self.log.debug("Stopping import process")
+        else:
+            report((jobid, "done", None))
+            app.notify(
+                "importer",
+                f"{kwargs['filename']} imported successfully ({data_type})",
+                description="",
+                type="success",
+                seen=False,
+                _global=True,
+            )
+        # After import is done, delete the temp file
+        os.remove(kwargs["tmpfile"])
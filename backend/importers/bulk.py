@@ -0,0 +1,41 @@
+import json
+import sqlite3
+
+
+def json_batches(c: sqlite3.Cursor, query: str, start: int, batch_size):
+    """
+    Runs the given query over an sqlite database in batches, yielding each batch as a JSON-encoded
+    heedy datapoint array, along with the number of datapoints and the timestamp of the last one.
+    The batch size is either a number, or a function returning the size of the next batch.
+
+    The query must return unique millisecond timestamps as column t, and datapoint values as column d,
+    and its only parameter must be a lower bound on t (exclusive). Batches are paged by timestamp, and
+    encoded by sqlite itself, so that no Python objects are created for individual datapoints.
+    """
+    batch_query = f"SELECT json_group_array(json_object('t', t / 1000.0, 'd', d)), MAX(t), COUNT(*) FROM ({query} ORDER BY t ASC LIMIT ?)"
+    size = batch_size if callable(batch_size) else lambda: batch_size
+    try:
+        c.execute(batch_query, (start, size()))
+    except sqlite3.OperationalError:
+        # sqlite was built without the JSON functions, so encode the rows in Python instead
+        yield from json_batches_fallback(c, query, start, size)
+        return
+    while True:
+        data, start, count = c.fetchone()
+        if count == 0:
+            return
+        yield data, count, start
+        c.execute(batch_query, (start, size()))
+
+
+def json_batches_fallback(c: sqlite3.Cursor, query: str, start: int, size):
+    c.execute(f"SELECT t / 1000.0, d, t FROM ({query} ORDER BY t ASC)", (start,))
+    data = c.fetchmany(size())
+    while len(data) > 0:
+        encoded = (
+            "["
+            + ",".join(['{"t":%r,"d":%s}' % (x[0], json.dumps(x[1])) for x in data])
+            + "]"
+        )
+        yield encoded, len(data), data[-1][2]
+        data = c.fetchmany(size())
@@ -0,0 +1,55 @@
+from datetime import datetime
+
+from .pipeline import BATCH_SIZE, MMOL_TO_MGDL, csv_importer, local_timestamp
+
+# The records of a Dexcom Clarity export that are imported, by event type
+CLARITY_EVENTS = {"EGV": "cgm", "Calibration": "blood_test"}
+# Readings out of the sensor's range are exported as Low or High
+CLARITY_LIMITS = {"Low": 40, "High": 400}
+
+
+def read_clarity(rows):
+    """
+    Reads a Dexcom Clarity CSV export, which has a header row, followed by rows describing the patient and
+    devices (without a timestamp), and then one row per event, with local timestamps such as 2021-03-01T08:04:05.
+    """
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = {name.split(" (")[0]: i for i, name in enumerate(header)}
+    if "Timestamp" not in columns or "Event Type" not in columns:
+        raise Exception("This is not a Dexcom Clarity CSV export")
+    time_col = columns["Timestamp"]
+    type_col = columns["Event Type"]
+    value_col = columns.get("Glucose Value")
+    if value_col is None:
+        raise Exception("The Dexcom Clarity export has no glucose values")
+    scale = MMOL_TO_MGDL if "mmol/L" in header[value_col] else 1
+
+    records = []
+    consumed = 1
+    for row in rows:
+        consumed += 1
+        if (
+            len(row) > value_col
+            and row[time_col] != ""
+            and row[type_col] in CLARITY_EVENTS
+        ):
+            value = row[value_col]
+            if value in CLARITY_LIMITS:
+                d = CLARITY_LIMITS[value]
+            elif value != "":
+                d = float(value) * scale
+            else:
+                d = None
+            if d is not None:
+                t = local_timestamp(datetime.fromisoformat(row[time_col]))
+                records.append((CLARITY_EVENTS[row[type_col]], t, d))
+        if consumed >= BATCH_SIZE:
+            yield records, consumed
+            records = []
+            consumed = 0
+    yield records, consumed
+
+
+clarity_import = csv_importer(read_clarity, "clarity")
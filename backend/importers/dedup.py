@@ -0,0 +1,54 @@
+from heedy import App
+import time
+
+# The app kv key holding the index of imported files
+IMPORTS_KEY = "imported_files"
+# The number of most recent imports kept in the index
+MAX_IMPORTS = 50
+# The timeseries written by importers, whose latest timestamps are stored as watermarks of each import
+OBJECTS = ["cgm", "blood_test", "events"]
+
+
+async def get_watermarks(app: App) -> dict:
+    watermarks = {}
+    for key in OBJECTS:
+        ts = (await app.objects(type="timeseries", key=key))[0]
+        last = await ts(i1=-1)
+        watermarks[key] = last[0]["t"] if len(last) > 0 else None
+    return watermarks
+
+
+async def is_imported(app: App, sha256: str, data_type: str, overwrite: bool) -> bool:
+    """
+    Checks whether a file with the given content hash was already imported into the app in a way that
+    makes importing it again a no-op: the earlier import succeeded with the same data type, it overwrote
+    existing data if this one would, and none of the data it left behind was removed since then.
+    """
+    imports = await app.kv[IMPORTS_KEY]
+    if imports is None or sha256 not in imports:
+        return False
+    previous = imports[sha256]
+    if previous["data_type"] != data_type or (overwrite and not previous["overwrite"]):
+        return False
+    watermarks = await get_watermarks(app)
+    for key, t in previous["watermarks"].items():
+        if t is not None and (watermarks.get(key) is None or watermarks[key] < t):
+            return False
+    return True
+
+
+async def record_import(app: App, sha256: str, data_type: str, overwrite: bool):
+    imports = await app.kv[IMPORTS_KEY]
+    if imports is None:
+        imports = {}
+    imports[sha256] = {
+        "data_type": data_type,
+        "overwrite": overwrite,
+        "time": time.time(),
+        "watermarks": await get_watermarks(app),
+    }
+    if len(imports) > MAX_IMPORTS:
+        oldest = sorted(imports, key=lambda k: imports[k]["time"])
+        for k in oldest[: len(imports) - MAX_IMPORTS]:
+            del imports[k]
+    await app.kv.update(**{IMPORTS_KEY: imports})
@@ -0,0 +1,82 @@
+from heedy import Timeseries
+import hashlib
+import json
+import sqlite3
+
+DAY = 24 * 60 * 60 * 1000
+# The source and timeseries are compared in blocks of this many milliseconds (a multiple of DAY)
+BLOCK_SPAN = 30 * DAY
+
+
+def canonical(t: float, d) -> bytes:
+    # Values are compared with the 15 significant digits that sqlite's JSON functions write,
+    # so that a datapoint compares equal to its source row once written to heedy
+    if isinstance(d, (int, float)) and not isinstance(d, bool):
+        return b"%.15g %.15g\n" % (t, d)
+    return b"%.15g %s\n" % (t, json.dumps(d).encode())
+
+
+def digests(datapoints: list) -> dict:
+    """
+    Returns the checksum of each day of the given sorted (seconds, value) datapoints
+    """
+    days = {}
+    for t, d in datapoints:
+        day = int(t * 1000 // DAY)
+        if day not in days:
+            days[day] = hashlib.sha1()
+        days[day].update(canonical(t, d))
+    return {day: h.digest() for day, h in days.items()}
+
+
+def diff_batches(c: sqlite3.Cursor, ts: Timeseries, query: str, start: int):
+    """
+    Compares the rows of a query (in the format expected by json_batches) with the datapoints the timeseries
+    already holds, yielding the rows that are missing or different as JSON-encoded datapoint arrays, one for
+    each block of BLOCK_SPAN, along with the number of datapoints, the timestamps of the first one and of
+    the end of the block, and the number of rows compared.
+
+    The comparison is Merkle-style: the checksum of a whole block is compared first, then those of the days
+    in blocks that differ, and only days that differ are compared datapoint by datapoint. Datapoints that
+    the timeseries holds, but the source doesn't, are left in place.
+    """
+    c.execute(f"SELECT MIN(t), MAX(t) FROM ({query})", (start,))
+    first, last = c.fetchone()
+    if first is None:
+        return
+    block = first // BLOCK_SPAN * BLOCK_SPAN
+    while block <= last:
+        block_end = block + BLOCK_SPAN
+        c.execute(
+            f"SELECT t / 1000.0, d FROM ({query}) WHERE t < ? ORDER BY t ASC",
+            (max(start, block - 1), block_end),
+        )
+        source = c.fetchall()
+        existing = [
+            (dp["t"], dp["d"]) for dp in ts(t1=block / 1000, t2=block_end / 1000)
+        ]
+
+        source_days = digests(source)
+        existing_days = digests(existing)
+        changed = []
+        if source_days != existing_days:
+            days = {
+                day for day, h in source_days.items() if existing_days.get(day) != h
+            }
+            stored = {
+                t: canonical(t, d) for t, d in existing if int(t * 1000 // DAY) in days
+            }
+            changed = [
+                {"t": t, "d": d}
+                for t, d in source
+                if int(t * 1000 // DAY) in days and stored.get(t) != canonical(t, d)
+            ]
+
+        yield (
+            json.dumps(changed),
+            len(changed),
+            changed[0]["t"] * 1000 if len(changed) > 0 else None,
+            block_end - 1,
+            len(source),
+        )
+        block = block_end
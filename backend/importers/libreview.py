@@ -0,0 +1,86 @@
+from datetime import datetime
+from itertools import chain, islice
+
+from .pipeline import (
+    BATCH_SIZE,
+    MMOL_TO_MGDL,
+    csv_importer,
+    local_timestamp,
+    time_format,
+)
+
+# The records of a LibreView export that are imported, by record type: the object they are written to, and
+# the column holding their glucose value (historic readings are every 15 minutes, scans are in between)
+LIBREVIEW_RECORDS = {
+    "0": ("cgm", "Historic Glucose"),
+    "1": ("cgm", "Scan Glucose"),
+    "2": ("blood_test", "Strip Glucose"),
+}
+
+# Device timestamps are written in the user's locale
+LIBREVIEW_TIME_FORMATS = [
+    "%m-%d-%Y %I:%M %p",
+    "%m-%d-%Y %H:%M",
+    "%d-%m-%Y %H:%M",
+    "%Y-%m-%d %H:%M",
+    "%m/%d/%Y %I:%M %p",
+    "%m/%d/%Y %H:%M",
+    "%d/%m/%Y %H:%M",
+    "%d.%m.%Y %H:%M",
+]
+
+
+def read_libreview(rows):
+    """
+    Reads a LibreView CSV export, which starts with a line describing the export, followed by a header row,
+    and one row per record, with local timestamps in the user's locale.
+    """
+    next(rows, None)
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = {}
+    scale = 1
+    for i, name in enumerate(header):
+        for unit, s in [(" mg/dL", 1), (" mmol/L", MMOL_TO_MGDL)]:
+            if name.endswith(unit):
+                name = name[: -len(unit)]
+                if name.endswith("Glucose"):
+                    scale = s
+        columns[name] = i
+    if "Device Timestamp" not in columns or "Record Type" not in columns:
+        raise Exception("This is not a LibreView CSV export")
+    time_col = columns["Device Timestamp"]
+    type_col = columns["Record Type"]
+    targets = {
+        rtype: (key, columns[col])
+        for rtype, (key, col) in LIBREVIEW_RECORDS.items()
+        if col in columns
+    }
+
+    # The timestamp format is detected from the first batch of rows
+    first = list(islice(rows, BATCH_SIZE))
+    fmt = time_format(
+        [r[time_col] for r in first if len(r) > time_col and r[time_col] != ""],
+        LIBREVIEW_TIME_FORMATS,
+    )
+
+    records = []
+    consumed = 2
+    for row in chain(first, rows):
+        consumed += 1
+        if len(row) > type_col and row[type_col] in targets:
+            key, value_col = targets[row[type_col]]
+            if len(row) > value_col and row[value_col] != "":
+                t = local_timestamp(datetime.strptime(row[time_col], fmt))
+                # Locales with decimal commas write mmol/L values such as 5,6
+                d = float(row[value_col].replace(",", ".")) * scale
+                records.append((key, t, d))
+        if consumed >= BATCH_SIZE:
+            yield records, consumed
+            records = []
+            consumed = 0
+    yield records, consumed
+
+
+libreview_import = csv_importer(read_libreview, "libreview")
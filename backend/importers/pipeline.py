@@ -0,0 +1,177 @@
+from typing import Callable, Iterator
+from heedy import App
+from datetime import datetime
+import logging
+import zipfile
+import csv
+import io
+
+from batching import BatchWriter
+from rollups import update_rollups
+
+# The number of source rows that readers put in each batch of records
+BATCH_SIZE = 10000
+# Glucose readings given in mmol/L are converted to mg/dL
+MMOL_TO_MGDL = 18.0182
+
+
+def open_text(tmpfile: str) -> io.TextIOBase:
+    """
+    Opens an uploaded text file for streaming, either as is, or from inside a zip file holding a single file
+    """
+    if not zipfile.is_zipfile(tmpfile):
+        return open(tmpfile, "r", encoding="utf-8-sig", newline="")
+    z = zipfile.ZipFile(tmpfile, "r")
+    zip_info = z.infolist()
+    if len(zip_info) != 1:
+        z.close()
+        raise Exception(
+            "Zip file contains more than one file, a single export is expected."
+        )
+    # The zip file is closed along with the member once its last reference goes away
+    return io.TextIOWrapper(z.open(zip_info[0]), encoding="utf-8-sig", newline="")
+
+
+def count_lines(tmpfile: str) -> int:
+    # Used as an upper bound on the number of records, to report progress
+    with open_text(tmpfile) as f:
+        return sum(1 for _ in f)
+
+
+def time_format(samples: list, formats: list) -> str:
+    """
+    Returns the first of the strptime formats that parses all of the sample timestamps. Exports that write
+    dates in the user's locale (such as 03-04-2021) are ambiguous row by row, so the format is chosen once.
+    """
+    for fmt in formats:
+        try:
+            for s in samples:
+                datetime.strptime(s, fmt)
+            return fmt
+        except ValueError:
+            pass
+    raise Exception(
+        f"Unrecognized timestamp format: {samples[0] if len(samples) > 0 else ''}"
+    )
+
+
+def local_timestamp(dt: datetime) -> float:
+    # Exports without a timezone hold the device's local time, which is assumed to be the server's
+    return dt.timestamp()
+
+
+def write_records(
+    app: App,
+    l: logging.Logger,
+    batches: Iterator,
+    source: str,
+    total: int = None,
+    overwrite: bool = False,
+    progress: Callable = lambda rows, total: None,
+    checkpoints: dict = {},
+    checkpoint: Callable = lambda key, t: None,
+    config: dict = {},
+):
+    """
+    Writes the records read by an import format reader to the app's timeseries. The reader yields batches of
+    (object key, timestamp, value) records, along with the number of source rows each batch was read from.
+
+    Unless overwriting, records at or before each timeseries' last datapoint when the import started (its
+    watermark) are skipped, since they were already imported. Records with the same timestamp are deduplicated
+    within each batch, keeping the last one. Checkpoints hold the watermarks and the number of source rows
+    written, so that a resumed import skips the batches that were already written, even if the source isn't
+    sorted by time. Records are written in batches sized by the writer, independently of the reader's batches.
+    """
+    targets = {}
+
+    def target(key: str):
+        if key not in targets:
+            ts = app.objects(type="timeseries", key=key)[0]
+            watermark = checkpoints.get(key + ".watermark")
+            if watermark is None:
+                watermark = 0
+                if not overwrite and len(ts) > 0:
+                    watermark = ts[-1]["t"]
+                    l.debug("Importing %s from %s", key, watermark)
+                checkpoint(key + ".watermark", watermark)
+            targets[key] = (ts, watermark)
+        return targets[key]
+
+    # The earliest cgm timestamp written, from which the rollups need updating
+    written_from = checkpoints.get("cgm.written_from")
+    done = checkpoints.get("rows", 0)
+    rows = 0
+    progress(rows, total)
+
+    def written(rows: int):
+        checkpoint("rows", rows)
+        progress(rows, total)
+
+    writer = BatchWriter(source, config)
+    try:
+        for records, consumed in batches:
+            rows += consumed
+            if rows <= done:
+                continue
+
+            by_key = {}
+            for key, t, d in records:
+                if t <= target(key)[1]:
+                    continue
+                if key not in by_key:
+                    by_key[key] = {}
+                by_key[key][t] = d
+
+            for key, points in by_key.items():
+                points = sorted(points.items())
+                if key == "cgm" and (
+                    written_from is None or points[0][0] < written_from
+                ):
+                    written_from = points[0][0]
+                    checkpoint("cgm.written_from", written_from)
+                writer.add(target(key)[0], points)
+            writer.after(lambda rows=rows: written(rows))
+        writer.flush()
+    finally:
+        writer.close()
+
+    if written_from is not None:
+        l.debug("Updating rollups")
+        update_rollups(app, written_from)
+
+
+def csv_importer(read: Callable, source: str) -> Callable:
+    """
+    Creates an importer (with the signature the Importer's worker processes call) from a format reader, which
+    is given a csv.reader over the uploaded file, and yields batches of records for write_records
+    """
+
+    def csv_import(
+        app: App,
+        l: logging.Logger,
+        filename: str = "",
+        tmpfile: str = "",
+        overwrite: bool = False,
+        progress: Callable = lambda rows, total: None,
+        checkpoints: dict = {},
+        checkpoint: Callable = lambda key, t: None,
+        config: dict = {},
+    ):
+        l.debug("Importing %s from %s (%s)", source, filename, tmpfile)
+        total = count_lines(tmpfile)
+        with open_text(tmpfile) as f:
+            write_records(
+                app,
+                l,
+                read(csv.reader(f)),
+                source,
+                total=total,
+                overwrite=overwrite,
+                progress=progress,
+                checkpoints=checkpoints,
+                checkpoint=checkpoint,
+                config=config,
+            )
+        progress(total, total)
+
+    return csv_import
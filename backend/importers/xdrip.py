@@ -1,9 +1,76 @@
+from typing import Callable
 from heedy import App
 import logging
 import zipfile
 import os
 import shutil
 import sqlite3
+from urllib.request import pathname2url
+
+from .bulk import json_batches
+from .diff import diff_batches
+from batching import BatchWriter
+from rollups import update_rollups
+
+# The queries giving the datapoints of each timeseries, in the format expected by json_batches:
+# CGM glucose data, finger-stick glucose data, and sensor start times
+xdrip_queries = [
+    (
+        "cgm",
+        "SELECT timestamp AS t, AVG(calculated_value) AS d FROM BgReadings WHERE timestamp > ? AND calculated_value > 0 GROUP BY timestamp",
+    ),
+    (
+        "blood_test",
+        "SELECT timestamp AS t, AVG(mgdl) AS d FROM BloodTest WHERE timestamp > ? AND mgdl > 0 GROUP BY timestamp",
+    ),
+    (
+        "events",
+        "SELECT DISTINCT started_at AS t, 'sensor_start' AS d FROM Sensors WHERE started_at > ?",
+    ),
+]
+
+
+def open_export(tmpfile: str, l: logging.Logger, memory_limit: int):
+    """
+    Opens the sqlite database inside an xDrip+ export zip file, without extracting it to a folder.
+    Databases up to memory_limit bytes are loaded straight into an in-memory database. Larger ones are
+    streamed into a single file next to the upload, which is opened read-only and memory-mapped.
+    Returns the database connection, and the file that needs to be removed once done (or None).
+    """
+    with zipfile.ZipFile(tmpfile, "r") as z:
+        zip_info = z.infolist()
+        if len(zip_info) != 1:
+            raise Exception(
+                "Zip file contains more than one file, an xdrip database export is expected."
+            )
+        if not zip_info[0].filename.endswith(".sqlite"):
+            raise Exception("Zip file does not contain an sqlite xdrip database export")
+        size = zip_info[0].file_size
+
+        if size <= memory_limit and hasattr(sqlite3.Connection, "deserialize"):
+            l.debug("Loading %d byte database into memory", size)
+            db = sqlite3.connect(":memory:")
+            db.deserialize(z.read(zip_info[0]))
+            return db, None
+
+        db_file = os.path.splitext(tmpfile)[0] + ".sqlite"
+        l.debug("Streaming %d byte database to %s", size, db_file)
+        try:
+            with z.open(zip_info[0]) as src, open(db_file, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        except:
+            if os.path.exists(db_file):
+                os.remove(db_file)
+            raise
+
+    # The file is never written while importing, so sqlite can skip locking and change detection
+    db = sqlite3.connect(
+        f"file:{pathname2url(os.path.abspath(db_file))}?mode=ro&immutable=1", uri=True
+    )
+    db.execute(f"PRAGMA mmap_size={size}")
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA query_only=ON")
+    return db, db_file
 
 
 def xdrip_import(
@@ -12,97 +79,87 @@ def xdrip_import(
     filename: str = "",
     tmpfile: str = "",
     overwrite: bool = False,
+    progress: Callable = lambda rows, total: None,
+    checkpoints: dict = {},
+    checkpoint: Callable = lambda key, t: None,
+    config: dict = {},
 ):
 
     l.debug("Importing xdrip from %s (%s)", filename, tmpfile)
 
-    extract_folder = os.path.splitext(tmpfile)[0]
+    db, db_file = open_export(
+        tmpfile, l, config.get("import_memory_limit", 64 * 1024 * 1024)
+    )
 
+    writer = BatchWriter("xdrip", config)
     try:
-
-        with zipfile.ZipFile(tmpfile, "r") as z:
-            zip_info = z.infolist()
-            if len(zip_info) != 1:
-                raise Exception(
-                    "Zip file contains more than one file, an xdrip database export is expected."
-                )
-            if not zip_info[0].filename.endswith(".sqlite"):
-                raise Exception(
-                    "Zip file does not contain an sqlite xdrip database export"
-                )
-
-            os.mkdir(extract_folder)
-            z.extract(zip_info[0], extract_folder)
-
-            db_file = os.path.join(extract_folder, zip_info[0].filename)
-
-        # Get CGM glucose data
-        cgm_readings = app.objects(type="timeseries", key="cgm")[0]
-
-        start_timestamp = 0
-        if not overwrite and len(cgm_readings) > 0:
-            start_timestamp = cgm_readings[-1]["t"]
-            l.debug("Importing cgm from %s", start_timestamp)
-
-        db = sqlite3.connect(db_file)
         c = db.cursor()
 
-        batch_size = 100000
-
-        c.execute(
-            "SELECT timestamp,AVG(calculated_value) FROM BgReadings WHERE timestamp > ? AND calculated_value > 0 GROUP BY timestamp ORDER BY timestamp ASC;",
-            (start_timestamp * 1000,),
-        )
-
-        data = c.fetchmany(batch_size)
-        while data is not None and len(data) > 0:
-            l.debug("Writing cgm batch with %d datapoints", len(data))
-            data = list(map(lambda x: {"t": x[0] / 1000, "d": x[1]}, data))
-            cgm_readings.insert_array(data)
-            data = c.fetchmany(batch_size)
-
-        # Get finger-stick glucose data
-        blood_test_readings = app.objects(type="timeseries", key="blood_test")[0]
-        start_timestamp = 0
-        if not overwrite and len(blood_test_readings) > 0:
-            start_timestamp = blood_test_readings[-1]["t"]
-            l.debug("Importing blood_test from %s", start_timestamp)
-
-        c.execute(
-            "SELECT timestamp,AVG(mgdl) FROM BloodTest WHERE timestamp > ? AND mgdl > 0 GROUP BY timestamp ORDER BY timestamp ASC;",
-            (start_timestamp * 1000,),
-        )
-
-        data = c.fetchmany(batch_size)
-        while data is not None and len(data) > 0:
-            l.debug("Writing blood_test batch with %d datapoints", len(data))
-            data = list(map(lambda x: {"t": x[0] / 1000, "d": x[1]}, data))
-            blood_test_readings.insert_array(data)
-            data = c.fetchmany(batch_size)
-
-        # Finally, extract sensor start and stop times
-        cgm_events = app.objects(type="timeseries", key="events")[0]
-        start_timestamp = 0
-        if not overwrite and len(cgm_events) > 0:
-            start_timestamp = cgm_events[-1]["t"]
-            l.debug("Importing cgm_events from %s", start_timestamp)
-
-        c.execute(
-            "SELECT DISTINCT started_at FROM Sensors WHERE started_at > ? ORDER BY started_at ASC",
-            (start_timestamp * 1000,),
-        )
-
-        data = c.fetchmany(batch_size)
-        while data is not None and len(data) > 0:
-            l.debug("Writing cgm_events batch with %d datapoints", len(data))
-            data = list(map(lambda x: {"t": x[0] / 1000, "d": "sensor_start"}, data))
-            cgm_events.insert_array(data)
-            data = c.fetchmany(batch_size)
-
+        # The total is an upper bound on the number of rows that will be imported,
+        # used to report progress
+        total = 0
+        for query in [
+            "SELECT COUNT(*) FROM BgReadings",
+            "SELECT COUNT(*) FROM BloodTest",
+            "SELECT COUNT(*) FROM Sensors",
+        ]:
+            c.execute(query)
+            total += c.fetchone()[0]
+        rows = 0
+        progress(rows, total)
+
+        for key, query in xdrip_queries:
+            ts = app.objects(type="timeseries", key=key)[0]
+            start_timestamp = 0
+            if not overwrite and len(ts) > 0:
+                start_timestamp = ts[-1]["t"]
+                l.debug("Importing %s from %s", key, start_timestamp)
+            start = max(start_timestamp * 1000, checkpoints.get(key, 0))
+
+            # The earliest timestamp written, from which the rollups need updating. It is checkpointed before
+            # writing, so that an interrupted overwrite still updates rollups from its earliest change.
+            written_from = checkpoints.get(key + ".written_from")
+
+            def write(data, count, first):
+                nonlocal written_from
+                if written_from is None or first < written_from:
+                    written_from = first
+                    checkpoint(key + ".written_from", written_from)
+                l.debug("Writing %s batch with %d datapoints", key, count)
+                writer.write_json(ts, data, count)
+
+            def written(last, count):
+                # Called by the writer once the rows up to last were written
+                nonlocal rows
+                checkpoint(key, last)
+                rows += count
+                progress(rows, total)
+
+            if overwrite:
+                # Only the datapoints that are missing or differ from the timeseries are written, so
+                # re-importing an export mostly reads and compares
+                for data, count, first, last, scanned in diff_batches(
+                    c, ts, query, start
+                ):
+                    if count > 0:
+                        write(data, count, first)
+                    writer.after(
+                        lambda last=last, scanned=scanned: written(last, scanned)
+                    )
+            else:
+                # The batch size follows the writer's, which adapts to how fast heedy accepts inserts
+                for data, count, last in json_batches(c, query, start, writer.size):
+                    write(data, count, start)
+                    writer.after(lambda last=last, count=count: written(last, count))
+            writer.flush()
+
+            if key == "cgm" and written_from is not None:
+                l.debug("Updating rollups")
+                update_rollups(app, written_from / 1000 if written_from > 0 else None)
+
+        progress(total, total)
+    finally:
+        writer.close()
         db.close()
-
-        shutil.rmtree(extract_folder)
-    except:
-        if os.path.exists(extract_folder):
-            shutil.rmtree(extract_folder)
-        raise
+        if db_file is not None:
+            os.remove(db_file)
@@ -1,32 +1,41 @@
-from sqlite3.dbapi2 import Time
 from aiohttp import web
-from heedy import Plugin, Timeseries
+from heedy import Plugin
 import asyncio
 import tempfile
-import zipfile
-import json
 import logging
-import tempfile
-import shutil
+import hashlib
+import time
 import os
 
-logging.basicConfig(level=logging.DEBUG)
-
 routes = web.RouteTableDef()
 
 # When starting the plugin server, heedy will send initialization data on STDIN.
 # The Plugin object reads this data, and connects with Heedy.
 p = Plugin()
+config = p.config["config"]["plugin"][p.name]["config"]
 
+logging.basicConfig(level=config.get("log_level", "DEBUG"))
 
-logging.basicConfig(level=logging.DEBUG)
-from importers import Importer
-from syncers import Syncer
+import metrics
 
-importer = Importer(p)
+metrics.enabled = config.get("metrics", True)
 
-# The temporary directory used for storing uploads
-tempdir = None
+from importers import Importer
+from syncers import Syncer, close_session, session_stats
+from syncers.scheduler import Scheduler
+from syncers.stream import Stream
+from syncers import leases
+from rollups import chart_level
+from appcache import AppCache
+from export import EXPORT_OBJECTS, NUMERIC_OBJECTS, FORMATS, export_chunks
+
+importer = Importer(p, config.get("num_processes", 1))
+Syncer.config = config
+if config.get("lease_file", "") != "":
+    # Syncs are sharded between the plugin instances sharing the lease file
+    leases.current = leases.Leases(config["lease_file"], config.get("lease_ttl", 15))
+apps = AppCache(p, config.get("app_cache_ttl", 60 * 60))
+scheduler = Scheduler(p, config, apps)
 
 l = logging.getLogger("cgm")
 
@@ -34,7 +43,7 @@ l = logging.getLogger("cgm")
 async def validate_request(request):
     if not p.isUser(request):
         raise Exception("Only users allowed")
-    app = await p.apps[request.match_info["appid"]]
+    app = await apps.get(request.match_info["appid"])
 
     username = request.headers["X-Heedy-As"]
     if username != "heedy" and app["owner"].username != username:
@@ -46,6 +55,38 @@ async def validate_request(request):
     return app
 
 
+def is_admin(request):
+    username = request.headers["X-Heedy-As"]
+    return username == "heedy" or username in p.config["config"].get("admin_users", [])
+
+
+@routes.get("/api/cgm/stats")
+async def stats(request):
+    if not is_admin(request):
+        return web.json_response(
+            {"error": "access_denied", "error_description": "Only admins allowed"},
+            status=403,
+        )
+    return web.json_response({"session": session_stats()})
+
+
+@routes.get("/api/cgm/metrics")
+async def get_metrics(request):
+    if not is_admin(request):
+        return web.json_response(
+            {"error": "access_denied", "error_description": "Only admins allowed"},
+            status=403,
+        )
+    if not metrics.enabled:
+        return web.json_response(
+            {"error": "not_found", "error_description": "Metrics are disabled"},
+            status=404,
+        )
+    return web.Response(
+        text=metrics.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
 @routes.post("/api/cgm/{appid}/sync")
 async def sync(request):
     try:
@@ -64,12 +105,49 @@ async def sync(request):
         description="",
         seen=False,
     )
-    await Syncer.sync(app)
+    scheduler.sync_now(app)
     # data = await request.json()
     # l.debug(data)
     return web.json_response({"result": "ok"})
 
 
+async def spool_upload(field, dirname: str):
+    """
+    Writes the uploaded file to a temporary file in the given directory, returning the file's name
+    and the sha256 hash of its contents. Chunks are gathered into larger blocks, which are written
+    and hashed in a thread, so that the event loop is not blocked by disk I/O.
+    """
+    loop = asyncio.get_running_loop()
+    h = hashlib.sha256()
+    fd, tfname = tempfile.mkstemp(
+        dir=dirname, suffix=os.path.splitext(field.filename)[1]
+    )
+    f = os.fdopen(fd, "wb")
+
+    def write(block):
+        h.update(block)
+        f.write(block)
+
+    try:
+        block = bytearray()
+        while True:
+            chunk = await field.read_chunk()
+            if not chunk:
+                break
+            block += chunk
+            if len(block) >= 1024 * 1024:
+                await loop.run_in_executor(None, write, bytes(block))
+                block.clear()
+        if len(block) > 0:
+            await loop.run_in_executor(None, write, bytes(block))
+    except:
+        f.close()
+        os.remove(tfname)
+        raise
+    f.close()
+    return tfname, h.hexdigest()
+
+
 @routes.post("/api/cgm/{appid}/import")
 async def import_data(request):
     try:
@@ -109,30 +187,10 @@ async def import_data(request):
                 )
             data["overwrite"] = ovr == "true"
         elif field.name == "data":
-            filename = field.filename
-
-            global tempdir
-            if tempdir is None:
-                tempdir = tempfile.mkdtemp(prefix="heedy_cgm_")
-                l.debug(f"Created tempdir {tempdir}")
-
-            tfname = tempfile.mktemp(dir=tempdir, suffix=os.path.splitext(filename)[1])
-            tf = open(tfname, "wb")
-
-            try:
-                while True:
-                    chunk = await field.read_chunk()
-                    if not chunk:
-                        break
-                    tf.write(chunk)
-            except:
-                tf.close()
-                os.remove(tfname)
-                raise
-            else:
-                tf.close()
-                data["filename"] = filename
-                data["tmpfile"] = tfname
+            data["filename"] = field.filename
+            data["tmpfile"], data["sha256"] = await spool_upload(
+                field, importer.spool_dir
+            )
         else:
             return web.json_response(
                 {
@@ -143,7 +201,7 @@ async def import_data(request):
             )
         field = await reader.next()
 
-    if tf is None:
+    if "tmpfile" not in data:
         return web.json_response(
             {
                 "error": "bad_request",
@@ -153,8 +211,10 @@ async def import_data(request):
         )
 
     try:
-        await importer.upload(app, **data)
+        jobid = await importer.upload(app, **data)
     except Exception as e:
+        if os.path.exists(data["tmpfile"]):
+            os.remove(data["tmpfile"])
         return web.json_response(
             {
                 "error": "bad_request",
@@ -163,20 +223,164 @@ async def import_data(request):
             status=400,
         )
 
+    if jobid is None:
+        return web.json_response({"result": "nothing_new"})
+    return web.json_response({"result": "ok", "job": jobid})
+
+
+def get_job(app, jobid: str):
+    if jobid not in importer.jobs or importer.jobs[jobid]["app"] != app["id"]:
+        raise Exception("Job not found")
+    return importer.job(jobid)
+
+
+@routes.get("/api/cgm/{appid}/import/{jobid}")
+async def import_status(request):
+    try:
+        app = await validate_request(request)
+        job = get_job(app, request.match_info["jobid"])
+    except:
+        l.exception("Error validating request")
+        return web.json_response(
+            {"error": "not_found", "error_description": "Import job not found"},
+            status=404,
+        )
+    return web.json_response(job)
+
+
+@routes.delete("/api/cgm/{appid}/import/{jobid}")
+async def import_cancel(request):
+    try:
+        app = await validate_request(request)
+        job = get_job(app, request.match_info["jobid"])
+    except:
+        l.exception("Error validating request")
+        return web.json_response(
+            {"error": "not_found", "error_description": "Import job not found"},
+            status=404,
+        )
+    importer.cancel(job["id"])
     return web.json_response({"result": "ok"})
 
 
+@routes.get("/api/cgm/{appid}/export")
+async def export_data(request):
+    try:
+        app = await validate_request(request)
+    except:
+        l.exception("Error validating request")
+        return web.json_response(
+            {"error": "not_found", "error_description": "App not found"}, status=403
+        )
+    fmt = request.query.get("format", "csv")
+    default_objects = NUMERIC_OBJECTS if fmt == "binary" else EXPORT_OBJECTS
+    keys = request.query.get("objects", ",".join(default_objects)).split(",")
+    zipped = request.query.get("zip", "false")
+    try:
+        t1 = float(request.query["t1"]) if "t1" in request.query else None
+        t2 = float(request.query["t2"]) if "t2" in request.query else None
+    except ValueError:
+        t1 = t2 = float("nan")
+    error = None
+    if fmt not in FORMATS:
+        error = "Unknown export format"
+    elif any(k not in EXPORT_OBJECTS for k in keys):
+        error = "Unknown export object"
+    elif fmt == "binary" and any(k not in NUMERIC_OBJECTS for k in keys):
+        error = "Only numeric objects can be exported in binary format"
+    elif zipped not in ["true", "false"]:
+        error = "Zip was not a boolean"
+    elif t1 != t1 or t2 != t2 or (t1 is not None and t2 is not None and t1 >= t2):
+        error = "Invalid time range"
+    if error is not None:
+        return web.json_response(
+            {"error": "bad_request", "error_description": error}, status=400
+        )
+    zipped = zipped == "true"
+
+    objects = []
+    for key in keys:
+        o = await app.objects(type="timeseries", key=key)
+        if len(o) > 0:
+            objects.append((key, o[0]))
+
+    ext = "zip" if zipped else fmt
+    r = web.StreamResponse(
+        headers={
+            "Content-Type": "application/zip" if zipped else FORMATS[fmt][0],
+            "Content-Disposition": f'attachment; filename="cgm_export.{ext}"',
+        }
+    )
+    r.enable_chunked_encoding()
+    await r.prepare(request)
+    async for chunk in export_chunks(objects, fmt, t1, t2, zipped):
+        if len(chunk) > 0:
+            await r.write(chunk)
+    await r.write_eof()
+    return r
+
+
+@routes.get("/api/cgm/{appid}/chart")
+async def chart(request):
+    try:
+        app = await validate_request(request)
+    except:
+        l.exception("Error validating request")
+        return web.json_response(
+            {"error": "not_found", "error_description": "App not found"}, status=403
+        )
+    try:
+        t2 = float(request.query.get("t2", time.time()))
+        t1 = float(request.query.get("t1", t2 - 60 * 60 * 24))
+        width = int(request.query.get("width", 1000))
+        if t1 >= t2 or width < 1:
+            raise ValueError()
+    except ValueError:
+        return web.json_response(
+            {
+                "error": "bad_request",
+                "error_description": "Invalid time range or width",
+            },
+            status=400,
+        )
+
+    # Charts get the cgm readings at the level of detail that fits the requested width, as
+    # the mean, min and max of each bucket
+    key, span = chart_level(t1, t2, width)
+    objects = await app.objects(type="timeseries", key=key)
+    if len(objects) == 0:
+        # The app was created before the rollup objects were added to the plugin
+        key = "cgm"
+        objects = await app.objects(type="timeseries", key=key)
+    if key == "cgm":
+        span = None
+        data = [
+            {"t": dp["t"], "d": {"mean": dp["d"], "min": dp["d"], "max": dp["d"]}}
+            for dp in await objects[0](t1=t1, t2=t2)
+        ]
+    else:
+        data = [
+            {
+                "t": dp["t"],
+                "dt": span,
+                "d": {k: dp["d"][k] for k in ["mean", "min", "max"]},
+            }
+            for dp in await objects[0](t1=t1 // span * span, t2=t2)
+        ]
+    return web.json_response({"level": key, "span": span, "data": data})
+
+
 @routes.post("/create")
 async def create(request):
     evt = await request.json()
 
     try:
-        app = await p.apps[evt["app"]]
+        app = await apps.get(evt["app"], refresh=True)
     except:
         # There is a bug in heedy that isn't easy to fix, sometimes the database doesn't yet show the write on first
         # create
         await asyncio.sleep(0.1)
-        app = await p.apps[evt["app"]]
+        app = await apps.get(evt["app"], refresh=True)
 
     await app.notify(
         "cgm",
@@ -193,7 +397,9 @@ async def create(request):
                         "type": "string",
                         "title": "Import Data Format",
                         "oneOf": [
-                            {"const": "xdrip", "title": "XDrip+ Database Export"}
+                            {"const": "xdrip", "title": "XDrip+ Database Export"},
+                            {"const": "clarity", "title": "Dexcom Clarity CSV Export"},
+                            {"const": "libreview", "title": "LibreView CSV Export"},
                         ],
                         "default": "xdrip",
                     },
@@ -206,7 +412,7 @@ async def create(request):
                     "data": {
                         "type": "object",
                         "title": "Choose a Zip File",
-                        "description": "A zip file containing exported data in the chosen upload data format.",
+                        "description": "A zip file containing exported data in the chosen upload data format. CSV exports can also be uploaded as they are.",
                         "contentMediaType": "application/zip",
                         "writeOnly": True,
                     },
@@ -216,6 +422,10 @@ async def create(request):
 You can upload data exported from a supported service directly into heedy. Currently, the following are available:
 
 - [XDrip+](https://github.com/jamorham/xDrip-plus) - click on `... > Import/Export Features > Export Database`, and upload the resulting zip file here.
+- [Dexcom Clarity](https://clarity.dexcom.com) - click on the export button at the top of the page, and upload the resulting CSV file here.
+- [LibreView](https://www.libreview.com) - click on `Download Glucose Data` in your profile, and upload the resulting CSV file here.
+
+Timestamps in CSV exports are in the device's local time, which is read as the server's local time.
 """,
             },
             {
@@ -226,6 +436,8 @@ You can upload data exported from a supported service directly into heedy. Curre
         ],
     )
 
+    scheduler.add(app)
+
     return web.Response(text="ok")
 
 
@@ -234,42 +446,54 @@ async def settings_update(request):
     evt = await request.json()
     l.debug("Settings update: %s", evt)
 
+    # The sync services might have changed, so sync right away
+    app = await apps.get(evt["app"], refresh=True)
+    scheduler.sync_now(app)
+
     return web.Response(text="ok")
 
 
-async def cleanup(app):
-    l.debug("Cleaning up")
-    global tempdir
-    if tempdir is not None:
-        shutil.rmtree(tempdir)
-        tempdir = None
-    await p.session.close()
+@routes.post("/update")
+async def update(request):
+    evt = await request.json()
+    l.debug("App update: %s", evt)
+    await apps.get(evt["app"], refresh=True)
+    return web.Response(text="ok")
 
 
-async def sync_all():
-    l.debug("Starting sync of all CGM services")
-    applist = await p.apps(plugin=f"{p.name}:{p.name}")
-    for a in applist:
-        if len(a["settings"]["sync_services"]) > 0:
-            await Syncer.sync(a)
+@routes.post("/delete")
+async def delete(request):
+    evt = await request.json()
+    l.debug("App deleted: %s", evt)
+    apps.invalidate(evt["app"])
+    scheduler.remove(evt["app"])
+    return web.Response(text="ok")
 
 
-async def sync_loop():
-    l.debug("Waiting 14 seconds before first sync")
-    await asyncio.sleep(14)
-    while True:
+async def cleanup(app):
+    l.debug("Cleaning up")
+    try:
+        scheduler.save()
+    except Exception as e:
+        l.error(f"Failed to save the schedule: {e}")
+    await Stream.close_all()
+    if leases.current is not None:
         try:
-            await sync_all()
+            await asyncio.get_running_loop().run_in_executor(
+                leases.current.executor, leases.current.close
+            )
         except Exception as e:
-            l.error(e)
-
-        wait_until = p.config["config"]["plugin"][p.name]["config"]["sync_every"]
-        l.debug(f"Waiting {wait_until} seconds until next auto-sync initiated")
-        await asyncio.sleep(wait_until)
+            l.error(f"Failed to release leases: {e}")
+        leases.current.executor.shutdown()
+    await close_session()
+    await p.session.close()
 
 
 async def startup(app):
-    asyncio.create_task(sync_loop())
+    # The import workers are forked first, while the plugin has no other threads
+    importer.start()
+    # The scheduler loads the apps (which fills the app cache) and syncs those that are due
+    asyncio.create_task(scheduler.run())
 
 
 # Runs the plugin's backend server
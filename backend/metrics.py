@@ -0,0 +1,209 @@
+"""
+Metrics of the plugin's syncers and importers, exposed in Prometheus' text format. Recording a value is a
+dict lookup and an addition, and does nothing at all when metrics are disabled.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+# Set from the plugin's configuration. When False, all recording functions return immediately.
+enabled = True
+
+# In importer worker processes, observations are passed to this function (which sends them to the main
+# process) instead of being recorded locally
+sink = None
+
+registry = {}
+
+# Imports in the main process record metrics from executor threads, so recording and rendering hold this lock
+lock = threading.Lock()
+
+# Functions called when rendering metrics, which return extra samples as
+# (name, type, help, [(labels, value), ...]) tuples
+collectors = []
+
+
+def labelstr(labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        registry[name] = self
+
+    def record(self, method: str, value: float, labels: dict):
+        # Records the value, either locally or through the sink
+        if sink is not None:
+            sink(self.name, method, value, labels)
+        else:
+            with lock:
+                getattr(self, "_" + method)(value, tuple(sorted(labels.items())))
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labelstr(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        if enabled:
+            self.record("inc", value, labels)
+
+    def _inc(self, value, labels):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        if enabled:
+            self.record("set", value, labels)
+
+    def inc(self, value: float = 1, **labels):
+        if enabled:
+            self.record("inc", value, labels)
+
+    def dec(self, value: float = 1, **labels):
+        if enabled:
+            self.record("inc", -value, labels)
+
+    def _set(self, value, labels):
+        self.values[labels] = value
+
+    def _inc(self, value, labels):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    ):
+        super().__init__(name, help)
+        self.buckets = list(buckets)
+
+    def observe(self, value: float, **labels):
+        if enabled:
+            self.record("observe", value, labels)
+
+    def time(self, **labels):
+        """
+        Returns a context manager that observes the time spent inside it
+        """
+        return Timer(self, labels)
+
+    def _observe(self, value, labels):
+        if labels not in self.values:
+            self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        h = self.values[labels]
+        h[0][bisect_left(self.buckets, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for le, c in zip(self.buckets + ["+Inf"], counts):
+                cumulative += c
+                yield self.name + "_bucket", labels + (("le", le),), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if enabled:
+            self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def apply(name: str, method: str, value: float, labels: dict):
+    """
+    Records an observation that was forwarded from a worker process's sink
+    """
+    registry[name].record(method, value, labels)
+
+
+def render() -> str:
+    with lock:
+        parts = [m.render() for m in registry.values()]
+    for collector in collectors:
+        for name, kind, help, samples in collector():
+            lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{labelstr(tuple(sorted(labels.items())))} {value}")
+            parts.append("\n".join(lines))
+    return "\n".join(parts) + "\n"
+
+
+sync_duration = Histogram(
+    "cgm_sync_duration_seconds",
+    "Time taken by each sync of an app, by sync service",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+sync_last_duration = Gauge(
+    "cgm_sync_last_duration_seconds", "Time taken by the last sync of each app"
+)
+sync_last_success = Gauge(
+    "cgm_sync_last_success_timestamp_seconds",
+    "Time at which each app last finished syncing successfully",
+)
+sync_errors = Counter("cgm_sync_errors_total", "Number of failed syncs, by service")
+request_duration = Histogram(
+    "cgm_sync_request_duration_seconds",
+    "Latency of requests to sync services (such as Nightscout), by host",
+)
+request_retries = Counter(
+    "cgm_sync_request_retries_total",
+    "Requests to sync services that were retried after failing, by host",
+)
+response_bytes = Counter(
+    "cgm_sync_response_bytes_total",
+    "Bytes of (decompressed) responses received from sync services, by host",
+)
+points_inserted = Counter(
+    "cgm_points_inserted_total",
+    "Datapoints written to heedy, by object key and source",
+)
+insert_duration = Histogram(
+    "cgm_insert_duration_seconds",
+    "Time spent in each write of datapoints to heedy, by object key and source",
+)
+import_last_success = Gauge(
+    "cgm_import_last_success_timestamp_seconds",
+    "Time at which each app last finished an import successfully",
+)
+import_job_duration = Histogram(
+    "cgm_import_job_duration_seconds",
+    "Time taken by each import job, by data type and result",
+    buckets=(0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
@@ -0,0 +1,192 @@
+"""
+Maintains the rollup timeseries of each app, which summarize its cgm readings over fixed time buckets
+(mean, range, variability and time in range), so that long-range views and analyses don't need to go
+through every raw reading.
+"""
+
+from heedy import App
+from heedy.base import AsyncSession
+import math
+
+# The rollup timeseries of the cgm object, and the length of their buckets in seconds.
+# Buckets are aligned to UTC, and each span must divide the next.
+ROLLUPS = [
+    ("cgm_15m", 60 * 15),
+    ("cgm_1h", 60 * 60),
+    ("cgm_6h", 60 * 60 * 6),
+    ("cgm_1d", 60 * 60 * 24),
+]
+
+# The levels of detail available for charting cgm data: the raw readings (usually one every 5 minutes),
+# followed by the rollups
+LEVELS = [("cgm", 60 * 5)] + ROLLUPS
+
+# The time range of raw data read at once when updating rollups. Must be a multiple of the largest span.
+CHUNK_SPAN = 60 * 60 * 24 * 30
+
+
+# The time in range buckets (mg/dL), from the international consensus on time in range
+TIR_BUCKETS = ["very_low", "low", "in_range", "high", "very_high"]
+
+
+def tir_index(v: float) -> int:
+    # The index of the reading's time in range bucket
+    if v < 70:
+        return 0 if v < 54 else 1
+    if v <= 180:
+        return 2
+    return 3 if v <= 250 else 4
+
+
+# Buckets are summarized by accumulating [count, sum, sum of squares, min, max, count in each time
+# in range bucket...] over their readings, so that coarser buckets can be merged from finer ones
+
+
+def accumulate(data: list, span: int) -> dict:
+    """
+    Accumulates the statistics of the given cgm datapoints in buckets of the given span
+    """
+    buckets = {}
+    for dp in data:
+        v = dp["d"]
+        b = dp["t"] // span * span
+        acc = buckets.get(b)
+        if acc is None:
+            acc = buckets[b] = [0, 0.0, 0.0, v, v] + [0] * len(TIR_BUCKETS)
+        acc[0] += 1
+        acc[1] += v
+        acc[2] += v * v
+        if v < acc[3]:
+            acc[3] = v
+        elif v > acc[4]:
+            acc[4] = v
+        acc[5 + tir_index(v)] += 1
+    return buckets
+
+
+def merge(buckets: dict, span: int) -> dict:
+    """
+    Merges accumulated buckets into buckets of a larger span
+    """
+    merged = {}
+    for b, acc in buckets.items():
+        mb = b // span * span
+        m = merged.get(mb)
+        if m is None:
+            merged[mb] = list(acc)
+            continue
+        m[0] += acc[0]
+        m[1] += acc[1]
+        m[2] += acc[2]
+        m[3] = min(m[3], acc[3])
+        m[4] = max(m[4], acc[4])
+        for i in range(5, len(m)):
+            m[i] += acc[i]
+    return merged
+
+
+def summarize(acc: list) -> dict:
+    """
+    Summarizes the accumulated glucose readings (in mg/dL) of a bucket. The glucose management indicator
+    (GMI) is estimated from the mean, and the coefficient of variation (CV) is given in percent.
+    """
+    n = acc[0]
+    mean = acc[1] / n
+    sd = math.sqrt(max(acc[2] / n - mean * mean, 0))
+    return {
+        "count": n,
+        "mean": mean,
+        "min": acc[3],
+        "max": acc[4],
+        "sd": sd,
+        "cv": 100 * sd / mean if mean > 0 else None,
+        "gmi": 3.31 + 0.02392 * mean,
+        "tir": {k: c / n for k, c in zip(TIR_BUCKETS, acc[5:])},
+    }
+
+
+def rollup(data: list) -> list:
+    """
+    Returns the datapoints of each rollup (in the order of ROLLUPS) for the given sorted cgm datapoints
+    """
+    result = []
+    buckets = None
+    for _, span in ROLLUPS:
+        buckets = accumulate(data, span) if buckets is None else merge(buckets, span)
+        result.append(
+            [{"t": b, "dt": span, "d": summarize(acc)} for b, acc in buckets.items()]
+        )
+    return result
+
+
+def rollup_steps(app: App, start: float):
+    # Updates the rollups as a generator, which yields each heedy request and is sent back its result,
+    # so that the same code runs with both sync and async sessions
+    cgm = (yield app.objects(type="timeseries", key="cgm"))[0]
+    targets = []
+    for key, span in ROLLUPS:
+        objects = yield app.objects(type="timeseries", key=key)
+        if len(objects) == 0:
+            # The app was created before the rollup objects were added to the plugin
+            return
+        targets.append((objects[0], span))
+
+    last = yield cgm(i1=-1)
+    if len(last) == 0:
+        return
+    # Rollups are written in time order, so continuing from the last one also covers data that was
+    # written without its rollups being updated (such as when the plugin stopped during a sync)
+    latest = yield targets[-1][0](i1=-1)
+    if len(latest) > 0 and (start is None or latest[0]["t"] < start):
+        start = latest[0]["t"]
+    if start is None:
+        start = (yield cgm(i2=1))[0]["t"]
+
+    t = start // targets[-1][1] * targets[-1][1]
+    while t <= last[0]["t"]:
+        data = yield cgm(t1=t, t2=t + CHUNK_SPAN)
+        for (ts, _), datapoints in zip(targets, rollup(data)):
+            if len(datapoints) > 0:
+                yield ts.insert_array(datapoints)
+        t += CHUNK_SPAN
+
+
+def run_steps(steps):
+    result = None
+    try:
+        while True:
+            result = steps.send(result)
+    except StopIteration:
+        pass
+
+
+async def run_steps_async(steps):
+    result = None
+    try:
+        while True:
+            result = await steps.send(result)
+    except StopIteration:
+        pass
+
+
+def update_rollups(app: App, start: float = None):
+    """
+    Updates the app's rollups over the cgm data written from the given timestamp onwards (or over everything
+    written since the last rollup, if not given).
+    Works with both sync and async sessions (returning an awaitable for async sessions).
+    """
+    steps = rollup_steps(app, start)
+    if isinstance(app.session, AsyncSession):
+        return run_steps_async(steps)
+    run_steps(steps)
+
+
+def chart_level(t1: float, t2: float, width: int):
+    """
+    Returns the key and span of the most detailed level that shows the given time range in at most
+    width points, or the coarsest level if none does
+    """
+    for key, span in LEVELS:
+        if (t2 - t1) / span <= width:
+            return key, span
+    return LEVELS[-1]
@@ -1,26 +1,38 @@
 import asyncio
 import logging
+import time
 
 from heedy import App
 from .nightscout import sync_nightscout
+from .session import close_session, session_stats
+import metrics
 
 
 class Syncer:
     active = {}
     alock = asyncio.Lock()
     syncers = {"nightscout": sync_nightscout}
+    # The plugin's configuration (from heedy.conf), which is passed to each syncer
+    config = {}
 
     @staticmethod
-    async def sync(app: App):
+    async def sync(app: App) -> asyncio.Task:
+        """
+        Starts syncing the app in the background, unless a sync is already running. Returns the sync's task,
+        which results in the number of datapoints that were synced, or None if the sync failed.
+        """
         appid = app["id"]
         async with Syncer.alock:
             if not appid in Syncer.active:
                 Syncer.active[appid] = Syncer(app)
             cursyncer = Syncer.active[appid]
+            # The app holds its cached settings, which might have changed since the last sync
+            cursyncer.app = app
             if cursyncer.task is not None and not cursyncer.task.done():
                 cursyncer.l.info("Sync already in progress - not starting a new one")
-                return
+                return cursyncer.task
             cursyncer.task = asyncio.create_task(cursyncer.run_sync())
+            return cursyncer.task
 
     def __init__(self, app):
         self.app = app
@@ -29,27 +41,37 @@ class Syncer:
         self.task = None
 
     async def run_sync(self):
+        start = time.perf_counter()
+        synced = await self.sync_services()
+        if synced is not None:
+            metrics.sync_last_duration.set(time.perf_counter() - start, app=self.appid)
+            metrics.sync_last_success.set(time.time(), app=self.appid)
+        return synced
+
+    async def sync_services(self):
         try:
             self.l.info("Starting sync")
 
-            # First, get the app's settings
-            settings = await self.app.settings
+            settings = self.app["settings"]
 
             services = settings["sync_services"]
 
             if len(services) == 0:
                 self.l.info("No sync services configured")
                 await self.app.notifications.delete("syncer")
-                return
+                return 0
 
+            synced = 0
             for service in services:
                 stype = service["service_type"]
                 self.l.info(f"Syncing {stype}")
                 try:
-                    await Syncer.syncers[stype](
-                        self.app, self.l.getChild(stype), service
-                    )
+                    with metrics.sync_duration.time(service=stype):
+                        synced += await Syncer.syncers[stype](
+                            self.app, self.l.getChild(stype), service, Syncer.config
+                        )
                 except Exception as e:
+                    metrics.sync_errors.inc(service=stype)
                     self.l.error(f"Error in sync {stype}: {e}")
                     await self.app.notify(
                         "syncer",
@@ -59,9 +81,10 @@ class Syncer:
                         description=f"```\n{str(e)}\n```",
                         seen=False,
                     )
-                    return
+                    return None
 
             await self.app.notifications.delete("syncer")
+            return synced
         except Exception as e:
             self.l.error(f"Error in sync: {e}")
             await self.app.notify(
@@ -72,3 +95,15 @@ class Syncer:
                 description=f"```\n{str(e)}\n```",
                 seen=False,
             )
+
+
+def collect_syncers():
+    running = sum(
+        1 for s in Syncer.active.values() if s.task is not None and not s.task.done()
+    )
+    yield "cgm_syncs_active", "gauge", "Number of apps currently syncing", [
+        ({}, running)
+    ]
+
+
+metrics.collectors.append(collect_syncers)
@@ -0,0 +1,38 @@
+"""
+Sorted sets of disjoint [start, end] time intervals, which record the ranges of a sync service's data that
+were already synced, so that syncs only request the ranges that are missing.
+"""
+
+
+def add_interval(intervals: list, start: float, end: float) -> list:
+    """
+    Returns the interval set with the given interval added, merging any intervals it touches
+    """
+    result = []
+    for a, b in intervals:
+        if b < start or a > end:
+            result.append([a, b])
+        else:
+            start = min(start, a)
+            end = max(end, b)
+    result.append([start, end])
+    result.sort()
+    return result
+
+
+def gaps(intervals: list, start: float, end: float) -> list:
+    """
+    Returns the parts of [start, end] that are not covered by the interval set
+    """
+    result = []
+    for a, b in intervals:
+        if b <= start:
+            continue
+        if a >= end:
+            break
+        if a > start:
+            result.append((start, a))
+        start = max(start, b)
+    if start < end:
+        result.append((start, end))
+    return result
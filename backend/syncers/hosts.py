@@ -0,0 +1,182 @@
+from aiohttp import ClientError, ClientResponseError, ClientSession
+from email.utils import parsedate_to_datetime
+from yarl import URL
+import asyncio
+import logging
+import random
+import time
+
+import metrics
+
+# Responses that mean the host is (hopefully temporarily) unable to answer, so the request is retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# The delay before the first retry of a request, which doubles with each further retry
+RETRY_DELAY = 1
+# Requests that the host asks to retry later than this fail instead of holding up the sync
+MAX_RETRY_DELAY = 5 * 60
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Host:
+    """
+    Host holds the state shared by all requests to a single host, whichever app they are for: a limit on
+    simultaneous requests, a token bucket limiting the rate of requests, any delay the host asked for with
+    Retry-After, and a circuit breaker. Once enough requests in a row fail, the circuit opens, and requests
+    fail right away until the cooldown passes. A single trial request is then let through, which closes
+    the circuit if it succeeds, and reopens it otherwise.
+    """
+
+    hosts = {}
+
+    @staticmethod
+    def get(url: str, config: dict) -> "Host":
+        host = URL(url).host
+        if host not in Host.hosts:
+            Host.hosts[host] = Host(host, config)
+        return Host.hosts[host]
+
+    def __init__(self, host: str, config: dict):
+        self.host = host
+        self.l = logging.getLogger(f"syncer.host.{host}")
+        self.limit = asyncio.Semaphore(config.get("nightscout_connections_per_host", 4))
+        self.rate = config.get("requests_per_host_per_second", 20)
+        # The bucket holds at least one token, so that rates below 1 per second still let requests through
+        self.capacity = max(self.rate, 1)
+        self.tokens = self.capacity
+        self.refilled = time.monotonic()
+        self.blocked_until = 0
+        self.max_failures = config.get("circuit_breaker_failures", 5)
+        self.cooldown = config.get("circuit_breaker_cooldown", 60)
+        self.failures = 0
+        self.opened = None
+        self.trial = None
+
+    async def wait_turn(self):
+        # Takes a token from the bucket, waiting for one if needed. A rate of 0 means no limit.
+        while True:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            if wait <= 0 and self.rate == 0:
+                return
+            if wait <= 0:
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.refilled) * self.rate
+                )
+                self.refilled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def check(self):
+        if self.opened is None:
+            return
+        # A trial request that never finished (such as when its sync was cancelled) is given up on
+        # after the cooldown
+        now = time.monotonic()
+        if now - self.opened < self.cooldown or (
+            self.trial is not None and now - self.trial < self.cooldown
+        ):
+            raise CircuitOpen(
+                f"Requests to {self.host} keep failing - waiting before trying again"
+            )
+        self.l.debug("Sending trial request")
+        self.trial = now
+
+    def succeeded(self):
+        if self.opened is not None:
+            self.l.info("Requests succeed again - closing circuit")
+        self.failures = 0
+        self.opened = None
+        self.trial = None
+
+    def failed(self):
+        self.failures += 1
+        if self.trial is not None or (
+            self.opened is None and self.failures >= self.max_failures
+        ):
+            self.l.warning(
+                "%d requests failed in a row - opening circuit", self.failures
+            )
+            self.opened = time.monotonic()
+            self.trial = None
+
+
+def parse_retry_after(value: str) -> float:
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+async def get_json(
+    s: ClientSession, url: str, config: dict, params: dict = None, headers: dict = None
+):
+    """
+    Returns the parsed JSON response to a GET request, going through the host's rate limit and circuit breaker.
+    Timeouts, connection errors and 429/5xx responses are retried (up to the request_retries setting) with
+    exponential backoff and jitter, waiting at least as long as asked for by Retry-After. Other errors are raised.
+    """
+    host = Host.get(url, config)
+    retries = config.get("request_retries", 4)
+    attempt = 0
+    while True:
+        host.check()
+        await host.wait_turn()
+        retry_after = None
+        try:
+            async with host.limit, s.get(url, params=params, headers=headers) as r:
+                if r.status not in RETRY_STATUSES:
+                    r.raise_for_status()
+                    data = await r.json()
+                    host.succeeded()
+                    return data
+                error = f"{r.status} {r.reason}"
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+        except ClientResponseError:
+            # Errors such as a bad token are not fixed by retrying, and the host is up
+            host.succeeded()
+            raise
+        except (ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        host.failed()
+
+        attempt += 1
+        if attempt > retries:
+            raise Exception(f"Request to {host.host} failed {attempt} times: {error}")
+        delay = min(RETRY_DELAY * 2 ** (attempt - 1), MAX_RETRY_DELAY)
+        delay *= random.uniform(0.5, 1.5)
+        if retry_after is not None:
+            if retry_after > MAX_RETRY_DELAY:
+                raise Exception(
+                    f"{host.host} asked to retry in {retry_after:.0f} seconds: {error}"
+                )
+            # The host asked everyone to wait, not just this request
+            host.blocked_until = max(host.blocked_until, time.monotonic() + retry_after)
+            delay = max(delay, retry_after)
+        host.l.debug("Request failed (%s) - retrying in %.1f seconds", error, delay)
+        metrics.request_retries.inc(host=host.host)
+        await asyncio.sleep(delay)
+
+
+def collect_hosts():
+    yield (
+        "cgm_sync_circuit_open",
+        "gauge",
+        "Whether requests to each host are held back by its circuit breaker",
+        [({"host": h.host}, int(h.opened is not None)) for h in Host.hosts.values()],
+    )
+
+
+metrics.collectors.append(collect_hosts)
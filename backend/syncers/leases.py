@@ -0,0 +1,168 @@
+"""
+Shards syncs between plugin instances that share a lease file (an sqlite database), so that each app is synced
+by a single live instance. Each instance keeps a heartbeat in the file, and apps are assigned to the live instances
+by rendezvous hashing, which spreads them evenly, and only moves the apps of instances that join or leave.
+
+An instance syncs an app only while holding its lease, which it renews every few seconds. Leases expire if they
+aren't renewed, so the apps of an instance that died are taken over once its lease TTL passes. Each change of a
+lease's owner increments its fencing token, and renewals only succeed with the token they were acquired with,
+so an instance that lost its lease (such as after stalling) can never renew it. Released leases are expired
+rather than deleted, so that their token keeps counting up. Writes to heedy are fenced by checking the lease
+right before them, and an instance stops treating its lease as held before it expires.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import time
+import uuid
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Leases:
+    def __init__(self, path: str, ttl: float = 15, instance: str = None):
+        # sqlite3 is only loaded when syncs are sharded
+        import sqlite3
+
+        self.instance = instance or uuid.uuid4().hex
+        self.ttl = ttl
+        self.l = logging.getLogger("syncer.leases")
+        # The apps whose leases this instance holds, with their fencing token and expiry time
+        self.held = {}
+        # The lease file is only accessed from this thread, so that waiting on its lock doesn't block the event loop
+        self.executor = ThreadPoolExecutor(1)
+        self.db = sqlite3.connect(
+            path, timeout=ttl / 3, isolation_level=None, check_same_thread=False
+        )
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS instances (id TEXT PRIMARY KEY, expires REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS leases (
+                app TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                token INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sync_requests (app TEXT PRIMARY KEY);
+            """)
+
+    def holds(self, appid: str) -> bool:
+        # Leases are given up locally a third of the TTL early, which leaves time for a write that
+        # passed the fence to finish before another instance can take over
+        lease = self.held.get(appid)
+        return lease is not None and time.time() < lease[1] - self.ttl / 3
+
+    def update(self, appids: list, busy: set):
+        """
+        Heartbeats this instance, and acquires, renews and releases leases, so that this instance holds the
+        leases of the given apps that are assigned to it. Leases of apps in busy (those being synced) are kept
+        until the sync finishes. Returns the apps whose leases were acquired and lost, and the apps held by this
+        instance for which another instance received a sync request.
+        """
+        now = time.time()
+        expires = now + self.ttl
+        c = self.db
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?)",
+                (self.instance, expires),
+            )
+            c.execute("DELETE FROM instances WHERE expires < ?", (now,))
+            live = [row[0] for row in c.execute("SELECT id FROM instances")]
+            leases = {
+                row[0]: row[1:]
+                for row in c.execute("SELECT app, owner, expires, token FROM leases")
+            }
+
+            held = {}
+            acquired = []
+            for appid in appids:
+                assigned = max(
+                    live, key=lambda i: hashlib.sha1(f"{i}/{appid}".encode()).digest()
+                )
+                owner, lease_expires, token = leases.get(appid, (None, 0, 0))
+                mine = (
+                    owner == self.instance
+                    and lease_expires > now
+                    and appid in self.held
+                    and self.held[appid][0] == token
+                )
+                if mine and (assigned == self.instance or appid in busy):
+                    c.execute(
+                        "UPDATE leases SET expires = ? WHERE app = ? AND token = ?",
+                        (expires, appid, token),
+                    )
+                    held[appid] = (token, expires)
+                elif assigned == self.instance and (
+                    owner is None or lease_expires <= now
+                ):
+                    c.execute(
+                        "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)",
+                        (appid, self.instance, expires, token + 1),
+                    )
+                    held[appid] = (token + 1, expires)
+                    acquired.append(appid)
+                elif mine:
+                    # The app was assigned to an instance that joined, which takes the lease on its next update
+                    c.execute(
+                        "UPDATE leases SET expires = 0 WHERE app = ? AND token = ?",
+                        (appid, token),
+                    )
+
+            # Leases of apps that no longer exist are released too
+            appids = set(appids)
+            for appid in self.held:
+                if appid not in held and appid not in appids:
+                    c.execute(
+                        "UPDATE leases SET expires = 0 WHERE app = ? AND owner = ? AND token = ?",
+                        (appid, self.instance, self.held[appid][0]),
+                    )
+
+            requested = [
+                row[0]
+                for row in c.execute("SELECT app FROM sync_requests")
+                if row[0] in held
+            ]
+            c.executemany(
+                "DELETE FROM sync_requests WHERE app = ?", [(a,) for a in requested]
+            )
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+
+        lost = [appid for appid in self.held if appid not in held]
+        self.held = held
+        return acquired, lost, requested
+
+    def request_sync(self, appid: str):
+        # Asks the instance holding the app's lease to sync it
+        self.db.execute("INSERT OR IGNORE INTO sync_requests VALUES (?)", (appid,))
+
+    def close(self):
+        # Releases all leases, so that other instances can take them over right away. Like update, this must
+        # run in the executor's thread.
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute(
+            "UPDATE leases SET expires = 0 WHERE owner = ?", (self.instance,)
+        )
+        self.db.execute("DELETE FROM instances WHERE id = ?", (self.instance,))
+        self.db.execute("COMMIT")
+        self.held = {}
+        self.db.close()
+
+
+# The leases of this instance, if syncs are sharded between instances
+current = None
+
+
+def fence(appid: str):
+    """
+    Raises LeaseLost unless this instance holds the app's lease (or syncs aren't sharded). Called right before
+    writing the app's synced data.
+    """
+    if current is not None and not current.holds(appid):
+        raise LeaseLost(f"This instance no longer holds the lease of app {appid}")
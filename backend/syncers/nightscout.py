@@ -3,33 +3,127 @@ from heedy import App, Timeseries
 import logging
 import asyncio
 from aiohttp import ClientSession
+from collections import deque
 from datetime import datetime
 import time
 
+from .session import get_session
+from .hosts import get_json
+from .coverage import add_interval, gaps
+from .leases import fence
+from batching import AsyncBatchWriter
+from rollups import update_rollups
 
-async def get_ns_start_time(s: ClientSession, url: str, l: logging.Logger):
+# The earliest timestamp that is considered valid data
+MIN_START_TIME = datetime(1980, 1, 1).timestamp()
+# How precisely the start of a Nightscout dataset is found
+START_TIME_PRECISION = 60 * 60 * 24
+
+# Caches the start of each Nightscout collection (by URL), so that apps syncing from
+# the same server don't need to search for it again
+ns_start_times = {}
+
+
+async def get_ns_start_time(
+    s: ClientSession, url: str, l: logging.Logger, config: dict, headers: dict = None
+):
     # There is no data in the timeseries, so we need to find the start time
-    # of the dataset in Nightscout
-    # We will go by years backwards until there is no more data before that year
-    # https://github.com/nightscout/cgm-remote-monitor/issues/5091
-    year = datetime.now().year
-    while year > 1980:
-        l.debug("Checking Nightscout for data before year %d", year)
-        async with s.get(
-            url,
-            params={
-                "count": 1,
-                "find[dateString][$lte]": f"{year}-01-01",
-            },
-        ) as r:
-            data = await r.json()
-            l.info(data)
-            if len(data) == 0:
-                return datetime.strptime(f"{year}-01-01", "%Y-%m-%d").timestamp()
-        year -= 1
-    raise Exception(
-        "Nightscout holds data from before 1980 - this is unlikely to be valid data, so not syncing."
-    )
+    # of the dataset in Nightscout. The API returns the newest entries first, and can't be sorted
+    # (https://github.com/nightscout/cgm-remote-monitor/issues/5091), so the start time is found
+    # by bisecting over find[date], checking whether there is data before each timestamp.
+    if url in ns_start_times:
+        return ns_start_times[url]
+
+    async def latest_before(t=None):
+        params = {"count": 1}
+        if t is not None:
+            params["find[date][$lte]"] = int(t * 1000)
+        data = await get_json(s, url, config, params, headers)
+        if len(data) == 0:
+            return None
+        return data[0]["date"] / 1000
+
+    hi = await latest_before()
+    if hi is None:
+        l.debug("Nightscout has no data at %s", url)
+        return time.time()
+    lo = MIN_START_TIME
+    if await latest_before(lo) is not None:
+        raise Exception(
+            "Nightscout holds data from before 1980 - this is unlikely to be valid data, so not syncing."
+        )
+
+    # lo always has no data before it, and hi always has data at or before it
+    while hi - lo > START_TIME_PRECISION:
+        mid = (lo + hi) / 2
+        l.debug("Checking Nightscout for data before %s", mid)
+        t = await latest_before(mid)
+        if t is None:
+            lo = mid
+        else:
+            hi = t
+    l.debug("Nightscout data at %s starts at %s", url, lo)
+    ns_start_times[url] = lo
+    return lo
+
+
+# Nightscout usually holds a CGM reading every 5 minutes, which is used to guess how
+# long a time range fits in a single page of results
+ENTRY_INTERVAL = 5 * 60
+# The longest time range requested at once when the data is sparse
+MAX_PAGE_SPAN = 60 * 60 * 24 * 365
+# The time range fetched by each worker of the backfill pipeline in upload_data
+WINDOW_SPAN = 60 * 60 * 24 * 30
+
+
+async def get_entries(
+    s: ClientSession,
+    url: str,
+    key: str,
+    start_time: float,
+    config: dict,
+    page_size: int = 2000,
+    end_time: float = None,
+    headers: dict = None,
+):
+    """
+    Yields the entries in the given Nightscout collection with a timestamp after start_time (and up to end_time,
+    if given) as sorted pages of (timestamp, value) tuples, holding at most page_size entries each.
+
+    The v1 API returns the newest entries first, so pages are requested by time range rather than by offset:
+    if a range returns a full page, it might be truncated, so it is halved and re-requested, and when ranges come
+    back sparse, they are doubled until MAX_PAGE_SPAN. Failed requests are retried by get_json, so an error only
+    interrupts the pages once retrying gives up.
+    """
+    cursor = int(start_time * 1000)
+    end = None if end_time is None else int(end_time * 1000)
+    span = page_size * ENTRY_INTERVAL * 1000 // 2
+    while end is None or cursor < end:
+        page_end = cursor + span
+        params = {"count": page_size, "find[date][$gt]": cursor}
+        if end is not None:
+            page_end = min(page_end, end)
+            params["find[date][$lte]"] = page_end
+        elif page_end < time.time() * 1000:
+            params["find[date][$lte]"] = page_end
+        else:
+            page_end = None
+
+        data = await get_json(s, url, config, params, headers)
+        if len(data) >= page_size and span > 1000:
+            span //= 2
+            continue
+
+        # Only the timestamp and value are kept, so that the full entry dicts can be freed right away
+        page = sorted((x["date"] / 1000, x[key]) for x in data if key in x)
+        del data
+        if len(page) > 0:
+            yield page
+        if page_end is None:
+            return
+        if len(page) < page_size // 4:
+            span = min(span * 2, MAX_PAGE_SPAN * 1000)
+        cursor = page_end
 
 
 async def upload_data(
@@ -38,83 +132,154 @@ async def upload_data(
     url: str,
     l: logging.Logger,
     key: str,
+    config: dict,
+    headers: dict = None,
 ):
+    """
+    Writes the entries of the given Nightscout collection that the timeseries is missing. The time ranges that were
+    already synced are kept in the timeseries' kv as an interval set, and only the gaps between them are requested.
+    Returns the number of datapoints written, and the timestamp of the earliest one (or None).
+    """
     l.debug("Syncing %s", url)
-    sync_time_key = f"nightscout_sync_time.{url}"
-    start_time = await ts.kv[sync_time_key]
-    if start_time is None:  # If we haven't synced yet, get nightscout data start time
+    page_size = config.get("nightscout_page_size", 2000)
+    connections = config.get("nightscout_connections_per_host", 4)
+    # Uploaders can send Nightscout readings some time after they were taken (such as after being offline),
+    # so the most recent data is not considered synced until it is older than this
+    settle_time = config.get("nightscout_settle_time", 3 * 60 * 60)
+
+    coverage_key = f"nightscout_coverage.{url}"
+    coverage = await ts.kv[coverage_key]
+    if coverage is None:
+        coverage = []
+        sync_time = await ts.kv[f"nightscout_sync_time.{url}"]
+        if sync_time is not None:
+            # Synced before coverage was kept, which always re-synced the last day before the sync time
+            coverage = [[MIN_START_TIME, sync_time - 60 * 60 * 24]]
+
+    current_time = time.time()
+    if len(coverage) > 0:
+        start_time = coverage[0][0]
+    else:
         l.debug(
             "This server has not synced to this timeseries - checking when Nightscout's dataset starts"
         )
-        start_time = await get_ns_start_time(s, url, l)
-    l.debug("Start sync time is %s", start_time)
-    start_time -= (
-        60 * 60 * 24
-    )  # amount of time before start time to look for data (1 day)
+        start_time = await get_ns_start_time(s, url, l, config, headers) - 60 * 60 * 24
+    settled = current_time - settle_time
 
-    current_time = time.time()
-    one_year = 60 * 60 * 24 * 365
-    while start_time < current_time - one_year:
-        end_time = start_time + one_year
-        l.debug("Syncing from %s to %s", start_time, end_time)
-        async with s.get(
-            url,
-            params={
-                "count": 1000000,  # A year has 525600 minutes, so a million should be more than enough
-                "find[date][$lte]": int(end_time * 1000),
-                "find[date][$gt]": int(start_time * 1000),
-            },
-        ) as r:
-            data = await r.json()
-        if len(data) > 0:
-            data = sorted(data, key=lambda x: x["date"])
-            l.debug(
-                "Got %d datapoints between %s %s",
-                len(data),
-                data[0]["dateString"],
-                data[-1]["dateString"],
+    # The missing ranges are split into windows, which are fetched concurrently (up to the number of
+    # connections allowed to the host) while the data is written in order by this function, with each
+    # window added to the coverage once it is written.
+    async def fetch_window(window_start, window_end):
+        return [
+            page
+            async for page in get_entries(
+                s, url, key, window_start, config, page_size, window_end, headers
             )
-            data = list(map(lambda x: {"t": x["date"] / 1000, "d": x[key]}, data))
-            await ts.insert_array(data)
-            await ts.kv.update(**{sync_time_key: data[-1]["t"]})
-
-        start_time = end_time
-    l.debug("Syncing from %s to now", start_time)
-    async with s.get(
-        url,
-        params={
-            "count": 1000000,
-            "find[date][$gt]": int(start_time * 1000),
-        },
-    ) as r:
-        data = await r.json()
-    data = sorted(data, key=lambda x: x["date"])
-    if len(data) > 0:
-        l.debug(
-            "Got %d datapoints between %s %s",
-            len(data),
-            data[0]["dateString"],
-            data[-1]["dateString"],
-        )
-        data = list(map(lambda x: {"t": x["date"] / 1000, "d": x[key]}, data))
-        await ts.insert_array(data)
-        await ts.kv.update(**{sync_time_key: data[-1]["t"]})
+        ]
+
+    def windows():
+        for gap_start, gap_end in gaps(coverage, start_time, current_time):
+            l.debug("Missing data between %s and %s", gap_start, gap_end)
+            window_start = gap_start
+            while window_start < gap_end:
+                window_end = min(window_start + WINDOW_SPAN, gap_end)
+                yield window_start, window_end
+                window_start = window_end
+
+    window_iter = windows()
+    pending = deque()
+
+    def fill_pipeline():
+        while len(pending) < connections:
+            w = next(window_iter, None)
+            if w is None:
+                return
+            pending.append((w, asyncio.create_task(fetch_window(*w))))
+
+    # Entries up to the timeseries' last datapoint might already be stored, and are checked against it
+    last = await ts(i1=-1)
+    stored_until = last[0]["t"] if len(last) > 0 else None
+
+    async def save_coverage(window_start, window_end):
+        # Called by the writer once the window's datapoints were written
+        nonlocal coverage
+        coverage = add_interval(coverage, window_start, window_end)
+        fence(ts["app"])
+        await ts.kv.update(**{coverage_key: coverage})
+
+    writer = AsyncBatchWriter("nightscout", config)
+    inserted = 0
+    first = None
+    fill_pipeline()
+    try:
+        while len(pending) > 0:
+            (window_start, window_end), task = pending.popleft()
+            pages = await task
+            fill_pipeline()
+            for page in pages:
+                l.debug(
+                    "Got %d datapoints between %s %s",
+                    len(page),
+                    page[0][0],
+                    page[-1][0],
+                )
+                if stored_until is not None and page[0][0] <= stored_until:
+                    stored = await ts(
+                        t1=page[0][0], t2=min(page[-1][0], stored_until) + 1
+                    )
+                    stored = {(dp["t"], dp["d"]) for dp in stored}
+                    page = [x for x in page if x not in stored]
+                    if len(page) == 0:
+                        continue
+                fence(ts["app"])
+                # Waits while heedy is behind on earlier writes, which also holds back fetching more windows
+                await writer.add(ts, page)
+                inserted += len(page)
+                if first is None or page[0][0] < first:
+                    first = page[0][0]
+            if min(window_end, settled) > window_start:
+                await writer.after(
+                    lambda a=window_start, b=min(window_end, settled): save_coverage(
+                        a, b
+                    )
+                )
+        await writer.flush()
+    finally:
+        writer.close()
+        for _, task in pending:
+            task.cancel()
+    l.debug("Wrote %d new datapoints", inserted)
+    return inserted, first
 
 
-async def sync_nightscout(app: App, l: logging.Logger, settings: dict):
+async def sync_nightscout(app: App, l: logging.Logger, settings: dict, config: dict):
     url = settings["url"]
     if url.endswith("/"):
         url = url[:-1]
     url = url + "/api/v1"
     l.debug("Syncing to %s", url)
-    async with ClientSession(headers={"API-SECRET": settings["api_key"]}) as s:
+    s = get_session(config)
+    headers = {"API-SECRET": settings["api_key"]}
 
-        # First, get the timeseries of sensor glucose
-        sgv = (await app.objects(key="cgm"))[0]
-        sgv_url = url + "/entries/sgv.json"
-        await upload_data(sgv, s, sgv_url, l, "sgv")
+    # The sensor glucose (cgm) and manual blood glucose (blood_test) collections
+    # are synced at the same time
+    sgv = (await app.objects(key="cgm"))[0]
+    mbg = (await app.objects(key="blood_test"))[0]
+    tasks = [
+        asyncio.create_task(
+            upload_data(sgv, s, url + "/entries/sgv.json", l, "sgv", config, headers)
+        ),
+        asyncio.create_task(
+            upload_data(mbg, s, url + "/entries/mbg.json", l, "mbg", config, headers)
+        ),
+    ]
+    try:
+        (sgv_synced, sgv_first), (mbg_synced, _) = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
 
-        # First, get the timeseries of manual blood glucose
-        mbg = (await app.objects(key="blood_test"))[0]
-        mbg_url = url + "/entries/mbg.json"
-        await upload_data(mbg, s, mbg_url, l, "mbg")
+    if sgv_synced > 0:
+        fence(app["id"])
+        await update_rollups(app, sgv_first)
+    return sgv_synced + mbg_synced
@@ -0,0 +1,339 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import random
+import time
+
+from heedy import App, Plugin
+from . import Syncer
+from .stream import Stream
+from . import leases
+from appcache import AppCache
+
+
+class Scheduler:
+    """
+    Scheduler keeps a heap of the times at which each CGM app is next due to sync, and runs the due syncs
+    with a cap on how many run at once. Apps are spread over the sync interval, and each app's interval
+    adapts to its data: apps that got new data are synced more often, and apps whose syncs keep coming
+    back empty are backed off. Apps whose services are all streamed are only polled as a fallback.
+
+    When syncs are sharded between plugin instances, every instance schedules every app, but only syncs
+    (and streams) the apps whose leases it holds. Manual syncs of other apps are passed on to their holder.
+
+    The schedule of each app (its last sync, due time, interval and failures) is saved to the state file in
+    the plugin's data directory, so that after a restart apps keep their schedule. Apps that became due while
+    the plugin was stopped are spread over startup_sync_spread seconds instead of all syncing at once.
+    """
+
+    def __init__(self, p: Plugin, config: dict, cache: AppCache):
+        self.p = p
+        self.cache = cache
+        self.config = config
+        self.l = logging.getLogger("syncer.scheduler")
+        self.sync_every = config["sync_every"]
+        self.active_sync_every = min(
+            config.get("active_sync_every", 5 * 60), self.sync_every
+        )
+        self.max_sync_every = max(
+            config.get("max_sync_every", 24 * 60 * 60), self.sync_every
+        )
+        self.retry_delay = config.get("sync_retry_delay", 60)
+        self.startup_spread = config.get("startup_sync_spread", 5 * 60)
+        self.slots = asyncio.Semaphore(config.get("max_concurrent_syncs", 10))
+
+        # Entries of the heap are (due time, sequence number, app id). Entries are not removed when an
+        # app is rescheduled - instead, entries whose due time doesn't match the app's are skipped.
+        # Manual syncs are pushed with a due time of 0, so they jump ahead of everything else.
+        self.heap = []
+        self.seq = 0
+        self.apps = {}
+        self.due = {}
+        self.intervals = {}
+        self.failures = {}
+        self.last_sync = {}
+        # Apps that became due while another instance held their lease, which sync as soon as this one gets it
+        self.deferred = set()
+        # Apps that were asked to sync while already syncing, which sync again once that sync finishes
+        self.resync = set()
+        self.wakeup = asyncio.Event()
+
+        self.state_file = os.path.abspath("scheduler_state.json")
+        self.saved = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        # The saved schedules are applied as the apps are added
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, "r") as f:
+                    self.saved = json.load(f)
+            except Exception as e:
+                self.l.error(f"Failed to read the saved schedule: {e}")
+
+    def save(self):
+        """
+        Writes the schedule of each app to the state file. Apps being synced are saved as due, so that
+        they are synced again if the plugin stops before the sync finishes.
+        """
+        now = time.time()
+        state = dict(self.saved)
+        for appid in self.apps:
+            due = self.due.get(appid)
+            state[appid] = {
+                "last_sync": self.last_sync.get(appid),
+                "due": now if due is None else due,
+                "interval": self.intervals.get(appid),
+                "failures": self.failures.get(appid, 0),
+            }
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_file + ".tmp", self.state_file)
+        self.changed = False
+
+    def push(self, appid: str, due: float):
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, appid))
+        self.wakeup.set()
+
+    def interval(self, appid: str) -> float:
+        # Each app can override the plugin's sync interval in its settings
+        return self.apps[appid]["settings"].get("sync_every", self.sync_every)
+
+    def add(self, app: App, spread: bool = True):
+        """
+        Adds the app to the schedule (or updates its cached data). New apps get a random due time within
+        their sync interval, so that syncs of many apps don't all happen at once.
+        """
+        appid = app["id"]
+        self.apps[appid] = app
+        if self.owns(appid):
+            Stream.update(app, self.config, self.stream_changed)
+        if appid not in self.due:
+            now = time.time()
+            saved = self.saved.pop(appid, None)
+            if saved is not None:
+                self.last_sync[appid] = saved["last_sync"]
+                if saved["interval"] is not None:
+                    self.intervals[appid] = saved["interval"]
+                if saved["failures"] > 0:
+                    self.failures[appid] = saved["failures"]
+                due = saved["due"]
+                if due <= now:
+                    due = now + random.uniform(0, self.startup_spread)
+            else:
+                due = now + (random.uniform(0, self.interval(appid)) if spread else 0)
+            self.due[appid] = due
+            self.push(appid, due)
+            self.changed = True
+
+    def owns(self, appid: str) -> bool:
+        return leases.current is None or leases.current.holds(appid)
+
+    def remove(self, appid: str):
+        Stream.unsubscribe(appid)
+        self.apps.pop(appid, None)
+        self.due.pop(appid, None)
+        self.intervals.pop(appid, None)
+        self.failures.pop(appid, None)
+        self.last_sync.pop(appid, None)
+        self.resync.discard(appid)
+        self.deferred.discard(appid)
+        self.saved.pop(appid, None)
+        self.changed = True
+
+    def sync_now(self, app: App):
+        """
+        Queues the app for sync ahead of all scheduled syncs
+        """
+        self.add(app)
+        self.push(app["id"], 0)
+
+    def stream_changed(self, app: App, connected: bool):
+        appid = app["id"]
+        if connected:
+            # Catch up on whatever arrived while the app wasn't streaming
+            self.sync_now(app)
+        elif self.due.get(appid) is not None:
+            # Go back to polling the app at its usual interval
+            due = time.time() + self.interval(appid)
+            if due < self.due[appid]:
+                self.due[appid] = due
+                self.push(appid, due)
+                self.changed = True
+
+    def reschedule(self, appid: str, synced):
+        base = self.interval(appid)
+        previous = self.intervals.get(appid, base)
+        failures = self.failures.pop(appid, 0)
+        if synced is None:
+            # Failed syncs are retried soon, backing off while they keep failing. The data that was
+            # written before the failure is kept, so the retry continues from there.
+            interval = min(self.retry_delay * 2**failures, base)
+            self.failures[appid] = failures + 1
+        elif Stream.covers(self.apps[appid]):
+            interval = self.max_sync_every
+        elif synced > 0:
+            interval = min(self.active_sync_every, base)
+        elif previous < base:
+            interval = base
+        else:
+            interval = min(previous * 2, self.max_sync_every)
+        self.intervals[appid] = interval
+        if synced is not None:
+            self.last_sync[appid] = time.time()
+
+        # The jitter keeps apps from drifting into lockstep
+        self.due[appid] = time.time() + interval * random.uniform(0.9, 1.1)
+        self.push(appid, self.due[appid])
+        self.changed = True
+
+    async def refresh(self):
+        """
+        Reloads the list of CGM apps from the cache, which lists them from heedy once its list expires
+        """
+        applist = await self.cache.all()
+        appids = set()
+        for a in applist:
+            appids.add(a["id"])
+            self.add(a)
+        for appid in list(self.apps):
+            if appid not in appids:
+                self.l.debug("App %s no longer exists - removing from schedule", appid)
+                self.remove(appid)
+        for appid in list(self.saved):
+            if appid not in appids:
+                self.remove(appid)
+
+    async def run_sync(self, appid: str):
+        try:
+            synced = await (await Syncer.sync(self.apps[appid]))
+        except Exception as e:
+            self.l.error(f"Error syncing {appid}: {e}")
+            synced = None
+        finally:
+            self.slots.release()
+        if appid in self.apps:
+            self.reschedule(appid, synced)
+            if appid in self.resync:
+                # A manual sync was requested while this sync was running
+                self.resync.discard(appid)
+                self.push(appid, 0)
+
+    async def request_sync(self, appid: str):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                leases.current.executor, leases.current.request_sync, appid
+            )
+        except Exception as e:
+            self.l.error(f"Failed to pass on sync request of {appid}: {e}")
+
+    async def lease_loop(self):
+        loop = asyncio.get_running_loop()
+        current = leases.current
+        while True:
+            busy = {
+                appid
+                for appid, s in Syncer.active.items()
+                if s.task is not None and not s.task.done()
+            }
+            try:
+                acquired, lost, requested = await loop.run_in_executor(
+                    current.executor, current.update, list(self.apps), busy
+                )
+            except Exception as e:
+                self.l.error(f"Failed to update leases: {e}")
+            else:
+                if len(acquired) > 0 or len(lost) > 0:
+                    self.l.debug(
+                        "Acquired %d and lost %d leases (holding %d)",
+                        len(acquired),
+                        len(lost),
+                        len(current.held),
+                    )
+                for appid in lost:
+                    Stream.unsubscribe(appid)
+                for appid in acquired:
+                    if appid in self.apps:
+                        Stream.update(
+                            self.apps[appid], self.config, self.stream_changed
+                        )
+                        if appid in self.deferred and self.due[appid] is not None:
+                            # The app was due while another instance held its lease
+                            self.due[appid] = time.time()
+                            self.push(appid, self.due[appid])
+                    self.deferred.discard(appid)
+                for appid in requested:
+                    if appid in self.apps:
+                        self.sync_now(self.apps[appid])
+            await asyncio.sleep(current.ttl / 3)
+
+    async def refresh_loop(self):
+        # Heedy might not accept requests yet when the plugin starts, so failed refreshes are retried
+        # soon, backing off up to the sync interval
+        delay = 1
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.l.error(e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.sync_every)
+            else:
+                delay = 1
+                await asyncio.sleep(self.sync_every)
+
+    async def save_loop(self):
+        while True:
+            await asyncio.sleep(10)
+            if self.changed:
+                try:
+                    self.save()
+                except Exception as e:
+                    self.l.error(f"Failed to save the schedule: {e}")
+
+    async def run(self):
+        asyncio.create_task(self.refresh_loop())
+        asyncio.create_task(self.save_loop())
+        if leases.current is not None:
+            asyncio.create_task(self.lease_loop())
+        while True:
+            if len(self.heap) == 0 or self.heap[0][0] > time.time():
+                timeout = None
+                if len(self.heap) > 0:
+                    timeout = self.heap[0][0] - time.time()
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.slots.acquire()
+            due, _, appid = heapq.heappop(self.heap)
+            if appid not in self.apps or (due != 0 and due != self.due.get(appid)):
+                self.slots.release()
+                continue
+            if self.due[appid] is None:
+                # A manual sync of an app that is already syncing runs again once that sync finishes
+                self.slots.release()
+                self.resync.add(appid)
+                continue
+            if not self.owns(appid):
+                self.slots.release()
+                if due == 0:
+                    asyncio.create_task(self.request_sync(appid))
+                else:
+                    self.deferred.add(appid)
+                    self.due[appid] = time.time() + self.intervals.get(
+                        appid, self.interval(appid)
+                    )
+                    self.push(appid, self.due[appid])
+                continue
+            self.l.debug("Starting scheduled sync of %s", appid)
+            self.due[appid] = None
+            asyncio.create_task(self.run_sync(appid))
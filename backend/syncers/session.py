@@ -0,0 +1,128 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+import logging
+import time
+
+import metrics
+
+l = logging.getLogger("syncer.session")
+
+# The connection-pooled session shared by all syncs. It is created on first use, since
+# aiohttp sessions need to be created from within the event loop.
+session = None
+
+# Streams hold their connections open indefinitely, so they get their own session, whose connections
+# don't count towards the shared session's limits
+stream_session = None
+
+# Counters of connection pool events, updated through aiohttp's request tracing
+pool_stats = {
+    "requests": 0,
+    "connections_created": 0,
+    "connections_reused": 0,
+    "connections_queued": 0,
+    "dns_cache_hits": 0,
+    "dns_cache_misses": 0,
+}
+
+
+def counter(name: str):
+    async def increment(session, ctx, params):
+        pool_stats[name] += 1
+
+    return increment
+
+
+async def request_start(session, ctx, params):
+    if metrics.enabled:
+        ctx.start = time.perf_counter()
+
+
+async def request_end(session, ctx, params):
+    if metrics.enabled:
+        metrics.request_duration.observe(
+            time.perf_counter() - ctx.start, host=params.url.host
+        )
+
+
+async def response_chunk(session, ctx, params):
+    metrics.response_bytes.inc(len(params.chunk), host=params.url.host)
+
+
+def get_session(config: dict) -> ClientSession:
+    """
+    Returns the plugin's shared ClientSession, creating it if necessary. Credentials are not part of the
+    session, since it is shared between apps - they are given as headers of each request.
+    """
+    global session
+    if session is None or session.closed:
+        l.debug("Creating shared client session")
+        trace = TraceConfig()
+        trace.on_request_start.append(counter("requests"))
+        trace.on_request_start.append(request_start)
+        trace.on_request_end.append(request_end)
+        trace.on_response_chunk_received.append(response_chunk)
+        trace.on_connection_create_end.append(counter("connections_created"))
+        trace.on_connection_reuseconn.append(counter("connections_reused"))
+        trace.on_connection_queued_start.append(counter("connections_queued"))
+        trace.on_dns_cache_hit.append(counter("dns_cache_hits"))
+        trace.on_dns_cache_miss.append(counter("dns_cache_misses"))
+
+        session = ClientSession(
+            connector=TCPConnector(
+                limit=config.get("max_connections", 100),
+                limit_per_host=config.get("nightscout_connections_per_host", 4),
+                ttl_dns_cache=5 * 60,
+                keepalive_timeout=60,
+            ),
+            headers={"Accept-Encoding": "gzip, deflate"},
+            timeout=ClientTimeout(total=config.get("request_timeout", 5 * 60)),
+            trace_configs=[trace],
+        )
+    return session
+
+
+def get_stream_session() -> ClientSession:
+    """
+    Returns the session used by streams, creating it if necessary
+    """
+    global stream_session
+    if stream_session is None or stream_session.closed:
+        l.debug("Creating stream client session")
+        stream_session = ClientSession(connector=TCPConnector(limit=0))
+    return stream_session
+
+
+async def close_session():
+    global session, stream_session
+    if session is not None:
+        l.debug("Closing shared client session")
+        await session.close()
+        session = None
+    if stream_session is not None:
+        await stream_session.close()
+        stream_session = None
+
+
+def session_stats() -> dict:
+    """
+    Returns statistics of the shared session's connection pool
+    """
+    stats = dict(pool_stats)
+    stats["open"] = session is not None and not session.closed
+    if stats["open"]:
+        connector = session.connector
+        stats["limit"] = connector.limit
+        stats["limit_per_host"] = connector.limit_per_host
+    return stats
+
+
+def collect_session():
+    yield (
+        "cgm_sync_pool_events_total",
+        "counter",
+        "Connection pool events of the shared sync session",
+        [({"event": k}, v) for k, v in pool_stats.items()],
+    )
+
+
+metrics.collectors.append(collect_session)
@@ -0,0 +1,228 @@
+from typing import Callable
+from aiohttp import WSMsgType
+from heedy import App
+from yarl import URL
+import asyncio
+import hashlib
+import json
+import logging
+import random
+
+from .session import get_stream_session
+from .leases import fence
+from rollups import update_rollups
+import metrics
+
+# Delay before reconnecting a stream that failed, which is doubled (up to the maximum) on each consecutive failure
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 5 * 60
+# Hours of past data that Nightscout sends right after a stream is authorized
+HISTORY_HOURS = 1
+
+# The collections in Nightscout's data updates, and the objects their entries are written to
+COLLECTIONS = {"sgvs": "cgm", "mbgs": "blood_test"}
+
+
+class Stream:
+    """
+    Stream holds a connection to the socket.io data update channel of a Nightscout server, and writes new entries
+    to the apps that sync from it as they arrive. Apps syncing from the same server with the same token share the
+    stream. When a stream connects, its apps are told so that they can be synced by polling, to catch up on entries
+    that arrived while it was down, and when it disconnects, so that they go back to being polled regularly.
+    """
+
+    # The streams by (url, api key), and the keys of the streams each app is subscribed to
+    streams = {}
+    subscriptions = {}
+
+    @staticmethod
+    def update(app: App, config: dict, on_change: Callable):
+        """
+        Subscribes the app to the streams of the Nightscout services in its settings that have streaming
+        enabled, and unsubscribes it from any others. on_change is called with the app and whether the
+        stream is connected whenever one of its streams connects or disconnects.
+        """
+        appid = app["id"]
+        keys = set()
+        for service in app["settings"].get("sync_services", []):
+            if service["service_type"] == "nightscout" and service.get("stream", False):
+                url = service["url"]
+                if url.endswith("/"):
+                    url = url[:-1]
+                keys.add((url, service["api_key"]))
+
+        for key in Stream.subscriptions.get(appid, set()) - keys:
+            Stream.streams[key].remove(appid)
+        for key in keys:
+            if key not in Stream.streams:
+                Stream.streams[key] = Stream(key[0], key[1], config)
+            Stream.streams[key].add(app, on_change)
+        Stream.subscriptions[appid] = keys
+
+    @staticmethod
+    def unsubscribe(appid: str):
+        for key in Stream.subscriptions.pop(appid, set()):
+            Stream.streams[key].remove(appid)
+
+    @staticmethod
+    def covers(app: App) -> bool:
+        """
+        Returns whether all of the app's sync services are being streamed
+        """
+        services = app["settings"].get("sync_services", [])
+        keys = Stream.subscriptions.get(app["id"], set())
+        return (
+            len(services) > 0
+            and len(keys) == len(services)
+            and all(Stream.streams[key].connected for key in keys)
+        )
+
+    @staticmethod
+    async def close_all():
+        for stream in list(Stream.streams.values()):
+            stream.task.cancel()
+        Stream.streams = {}
+        Stream.subscriptions = {}
+
+    def __init__(self, url: str, api_key: str, config: dict):
+        self.url = url
+        self.api_key = api_key
+        self.config = config
+        self.l = logging.getLogger(f"syncer.stream.{URL(url).host}")
+        self.apps = {}
+        self.objects = {}
+        self.connected = False
+        self.task = asyncio.create_task(self.run())
+
+    def add(self, app: App, on_change: Callable):
+        appid = app["id"]
+        joined = appid not in self.apps
+        self.apps[appid] = (app, on_change)
+        if joined and self.connected:
+            # The app might be missing entries from before it joined
+            on_change(app, True)
+
+    def remove(self, appid: str):
+        self.apps.pop(appid, None)
+        self.objects.pop(appid, None)
+        if len(self.apps) == 0:
+            self.l.debug("No apps left - closing stream")
+            self.task.cancel()
+            del Stream.streams[(self.url, self.api_key)]
+
+    def set_connected(self, connected: bool):
+        if connected != self.connected:
+            self.connected = connected
+            for app, on_change in list(self.apps.values()):
+                on_change(app, connected)
+
+    async def run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await self.connect()
+                self.l.debug("Stream closed by Nightscout")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.l.warning(f"Stream failed: {e}")
+            if self.connected:
+                delay = RECONNECT_DELAY
+                self.set_connected(False)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def connect(self):
+        # Speaks the Engine.IO 4 / socket.io 5 protocol used by Nightscout over a websocket: packets are text,
+        # prefixed by their type (0 open, 2 ping, 3 pong, 40 connect, 41 disconnect, 42 event, 43 ack)
+        url = URL(self.url + "/socket.io/").with_query(EIO="4", transport="websocket")
+        self.l.debug("Connecting to %s", url)
+        async with get_stream_session().ws_connect(url) as ws:
+            timeout = self.config.get("request_timeout", 5 * 60)
+            while True:
+                msg = await ws.receive(timeout=timeout)
+                if msg.type != WSMsgType.TEXT:
+                    return
+                packet = msg.data
+                if packet.startswith("0"):
+                    # Nightscout pings every pingInterval, so a connection that is silent for longer is dead
+                    handshake = json.loads(packet[1:])
+                    timeout = (
+                        handshake["pingInterval"] + handshake["pingTimeout"]
+                    ) / 1000
+                    await ws.send_str("40")
+                elif packet == "2":
+                    await ws.send_str("3")
+                elif packet.startswith("40"):
+                    await ws.send_str(
+                        "421"
+                        + json.dumps(
+                            [
+                                "authorize",
+                                {
+                                    "client": "web",
+                                    "secret": hashlib.sha1(
+                                        self.api_key.encode()
+                                    ).hexdigest(),
+                                    "token": self.api_key,
+                                    "history": HISTORY_HOURS,
+                                },
+                            ]
+                        )
+                    )
+                elif packet.startswith("431"):
+                    auth = json.loads(packet[3:])[0]
+                    if not auth.get("read", False):
+                        raise Exception("Not authorized to read data")
+                    self.l.debug("Stream connected")
+                    self.set_connected(True)
+                elif packet.startswith("42"):
+                    event = json.loads(packet[2:])
+                    if event[0] == "dataUpdate" and len(event) > 1:
+                        await self.deliver(event[1])
+                elif packet.startswith("41"):
+                    return
+
+    async def deliver(self, update: dict):
+        for collection, key in COLLECTIONS.items():
+            data = sorted(
+                (x["mills"] / 1000, x.get("mgdl", x.get("sgv")))
+                for x in update.get(collection, [])
+                if "mills" in x and x.get("mgdl", x.get("sgv")) is not None
+            )
+            if len(data) == 0:
+                continue
+            self.l.debug("Got %d %s entries", len(data), collection)
+            for appid, (app, _) in list(self.apps.items()):
+                try:
+                    await self.write(app, key, data)
+                except Exception as e:
+                    self.l.error(f"Failed to write streamed entries to {appid}: {e}")
+
+    async def write(self, app: App, key: str, data: list):
+        # The sync time is left to polling, since entries can be missing before the ones that were streamed
+        appid = app["id"]
+        if appid not in self.objects:
+            self.objects[appid] = {}
+        if key not in self.objects[appid]:
+            self.objects[appid][key] = (await app.objects(type="timeseries", key=key))[
+                0
+            ]
+        ts = self.objects[appid][key]
+        fence(appid)
+        with metrics.insert_duration.time(object=key, source="nightscout_stream"):
+            await ts.insert_array([{"t": t, "d": d} for t, d in data])
+        metrics.points_inserted.inc(len(data), object=key, source="nightscout_stream")
+        if key == "cgm":
+            await update_rollups(app, data[0][0])
+
+
+def collect_streams():
+    connected = sum(1 for s in Stream.streams.values() if s.connected)
+    yield "cgm_streams", "gauge", "Number of Nightscout streams, by state", [
+        ({"state": "connected"}, connected),
+        ({"state": "disconnected"}, len(Stream.streams) - connected),
+    ]
+
+
+metrics.collectors.append(collect_streams)
@@ -0,0 +1,209 @@
+"""
+An in-memory fake of the subset of heedy's REST API used by the plugin: apps, their timeseries objects,
+key-value stores and notifications. The plugin talks to it through the real heedy client, so benchmarks
+exercise the same code (and serialization) as they would against heedy.
+"""
+
+from aiohttp import web
+from bisect import bisect_left
+import json
+
+# The timeseries objects each CGM app has (as in heedy.conf)
+OBJECTS = ["cgm", "blood_test", "events", "cgm_15m", "cgm_1h", "cgm_6h", "cgm_1d"]
+
+
+class FakeTimeseries:
+    def __init__(self):
+        self.data = {}
+        self.times = None  # Sorted timestamps, rebuilt lazily after inserts
+
+    def sorted_times(self):
+        if self.times is None:
+            self.times = sorted(self.data)
+        return self.times
+
+    def query(self, q) -> list:
+        times = self.sorted_times()
+        if "t" in q:
+            t = float(q["t"])
+            return [{"t": t, "d": self.data[t]}] if t in self.data else []
+        lo, hi = 0, len(times)
+        if "t1" in q:
+            lo = bisect_left(times, float(q["t1"]))
+        if "t2" in q:
+            hi = bisect_left(times, float(q["t2"]))
+        selected = times[lo:hi]
+        if "i" in q:
+            i = int(q["i"])
+            selected = selected[i : i + 1 if i != -1 else None]
+        if "i1" in q or "i2" in q:
+            selected = selected[
+                int(q["i1"]) if "i1" in q else None : (
+                    int(q["i2"]) if "i2" in q else None
+                )
+            ]
+        if "limit" in q:
+            selected = selected[: int(q["limit"])]
+        return [{"t": t, "d": self.data[t]} for t in selected]
+
+    def insert(self, datapoints: list):
+        for dp in datapoints:
+            self.data[dp["t"]] = dp["d"]
+        self.times = None
+
+    def remove(self, q):
+        for dp in self.query(q):
+            del self.data[dp["t"]]
+        self.times = None
+
+
+def make_app(plugin: str = "cgm") -> web.Application:
+    """
+    Creates the fake heedy server. Apps are created the first time they are accessed, with the plugin's
+    CGM objects and empty settings. GET /_stats returns request and datapoint counts.
+    """
+    apps = {}
+    timeseries = {}
+    kv = {}
+    stats = {"requests": 0, "inserted": 0, "insert_requests": 0}
+
+    def get_app(appid: str) -> dict:
+        if appid not in apps:
+            apps[appid] = {
+                "id": appid,
+                "name": "Glucose Monitor",
+                "owner": "test",
+                "plugin": f"{plugin}:{plugin}",
+                "settings": {"sync_services": []},
+                "enabled": True,
+            }
+            for key in OBJECTS:
+                timeseries[f"{appid}.{key}"] = FakeTimeseries()
+        return apps[appid]
+
+    def object_record(objectid: str) -> dict:
+        appid, key = objectid.rsplit(".", 1)
+        return {
+            "id": objectid,
+            "name": key,
+            "key": key,
+            "type": "timeseries",
+            "app": appid,
+            "owner": apps[appid]["owner"],
+            "meta": {},
+        }
+
+    @web.middleware
+    async def count_requests(request, handler):
+        stats["requests"] += 1
+        return await handler(request)
+
+    routes = web.RouteTableDef()
+
+    @routes.get("/api/apps")
+    async def list_apps(request):
+        return web.json_response(
+            [
+                a
+                for a in apps.values()
+                if "plugin" not in request.query
+                or a["plugin"] == request.query["plugin"]
+            ]
+        )
+
+    @routes.get("/api/apps/{appid}")
+    async def read_app(request):
+        return web.json_response(get_app(request.match_info["appid"]))
+
+    @routes.patch("/api/apps/{appid}")
+    async def update_app(request):
+        a = get_app(request.match_info["appid"])
+        a.update(await request.json())
+        return web.json_response(a)
+
+    @routes.get("/api/objects")
+    async def list_objects(request):
+        get_app(request.query["app"])
+        key = request.query.get("key")
+        return web.json_response(
+            [
+                object_record(f"{request.query['app']}.{k}")
+                for k in OBJECTS
+                if key is None or key == k
+            ]
+        )
+
+    @routes.get("/api/objects/{objectid}")
+    async def read_object(request):
+        return web.json_response(object_record(request.match_info["objectid"]))
+
+    @routes.get("/api/objects/{objectid}/timeseries")
+    async def query_timeseries(request):
+        ts = timeseries[request.match_info["objectid"]]
+        return web.json_response(ts.query(request.query))
+
+    @routes.get("/api/objects/{objectid}/timeseries/length")
+    async def timeseries_length(request):
+        return web.json_response(len(timeseries[request.match_info["objectid"]].data))
+
+    @routes.post("/api/objects/{objectid}/timeseries")
+    async def insert_timeseries(request):
+        datapoints = json.loads(await request.read())
+        timeseries[request.match_info["objectid"]].insert(datapoints)
+        stats["inserted"] += len(datapoints)
+        stats["insert_requests"] += 1
+        return web.json_response({"result": "ok"})
+
+    @routes.delete("/api/objects/{objectid}/timeseries")
+    async def remove_timeseries(request):
+        timeseries[request.match_info["objectid"]].remove(request.query)
+        return web.json_response({"result": "ok"})
+
+    def kv_store(request) -> dict:
+        m = request.match_info
+        k = (m["kind"], m["id"], m["namespace"])
+        if k not in kv:
+            kv[k] = {}
+        return kv[k]
+
+    @routes.get("/api/kv/{kind}/{id}/{namespace}")
+    async def read_kv(request):
+        return web.json_response(kv_store(request))
+
+    @routes.post("/api/kv/{kind}/{id}/{namespace}")
+    async def set_kv(request):
+        store = kv_store(request)
+        store.clear()
+        store.update(await request.json())
+        return web.json_response({"result": "ok"})
+
+    @routes.patch("/api/kv/{kind}/{id}/{namespace}")
+    async def update_kv(request):
+        kv_store(request).update(await request.json())
+        return web.json_response({"result": "ok"})
+
+    @routes.get("/api/kv/{kind}/{id}/{namespace}/{key}")
+    async def read_kv_key(request):
+        return web.json_response(kv_store(request).get(request.match_info["key"]))
+
+    @routes.delete("/api/kv/{kind}/{id}/{namespace}/{key}")
+    async def delete_kv_key(request):
+        kv_store(request).pop(request.match_info["key"], None)
+        return web.json_response({"result": "ok"})
+
+    @routes.route("*", "/api/notifications")
+    async def notifications(request):
+        return web.json_response({"result": "ok"})
+
+    @routes.get("/_stats")
+    async def get_stats(request):
+        return web.json_response(
+            {
+                **stats,
+                "datapoints": {k: len(ts.data) for k, ts in timeseries.items()},
+            }
+        )
+
+    app = web.Application(middlewares=[count_requests], client_max_size=1024**3)
+    app.add_routes(routes)
+    return app
@@ -0,0 +1,148 @@
+"""
+A local stand-in for the parts of the Nightscout v1 API used by the syncer: the sgv and mbg entry collections,
+queried with count and find[date] filters, returning the newest matching entries first, and the socket.io
+data update channel used by streams.
+"""
+
+from aiohttp import web, WSMsgType
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+import asyncio
+import json
+
+
+def make_app(collections: dict, latency: float = 0) -> web.Application:
+    """
+    Creates the emulator's aiohttp app. collections maps collection names ("sgv" and "mbg") to sorted lists of
+    (millisecond timestamp, value) tuples. Each request is delayed by latency seconds.
+
+    Only entries up to the app's "visible_until" timestamp (in milliseconds) are served, which can be moved
+    forward with POST /_visible_until?t=... to simulate new data arriving. Newly visible entries are sent to
+    authorized socket.io clients as a data update. POST /_fail?n=...&status=...&retry_after=... makes the next n
+    entry requests fail with the given status. GET /_stats returns request counts.
+    """
+    stats = {"requests": 0, "entries": 0, "streams": 0}
+    state = {"visible_until": None, "failures": 0}
+    sockets = set()
+    dates = {k: [x[0] for x in v] for k, v in collections.items()}
+
+    def entries(request):
+        collection = request.match_info["collection"]
+        if collection not in collections:
+            raise web.HTTPNotFound()
+        data = collections[collection]
+        d = dates[collection]
+        q = request.query
+
+        lo, hi = 0, len(d)
+        if "find[date][$gt]" in q:
+            lo = max(lo, bisect_right(d, int(q["find[date][$gt]"])))
+        if "find[date][$gte]" in q:
+            lo = max(lo, bisect_left(d, int(q["find[date][$gte]"])))
+        if "find[date][$lte]" in q:
+            hi = min(hi, bisect_right(d, int(q["find[date][$lte]"])))
+        if "find[date][$lt]" in q:
+            hi = min(hi, bisect_left(d, int(q["find[date][$lt]"])))
+        if state["visible_until"] is not None:
+            hi = min(hi, bisect_right(d, state["visible_until"]))
+        count = int(q.get("count", 10))
+        lo = max(lo, hi - count)
+
+        return [
+            {
+                "_id": f"{collection}{t}",
+                "device": "emulator",
+                "date": t,
+                "dateString": datetime.fromtimestamp(
+                    t / 1000, timezone.utc
+                ).isoformat(),
+                collection: v,
+                "type": collection,
+            }
+            for t, v in reversed(data[lo:hi])
+        ]
+
+    async def get_entries(request):
+        stats["requests"] += 1
+        if latency > 0:
+            await asyncio.sleep(latency)
+        if state["failures"] > 0:
+            state["failures"] -= 1
+            headers = {}
+            if state["retry_after"] is not None:
+                headers["Retry-After"] = state["retry_after"]
+            return web.Response(status=state["status"], headers=headers)
+        result = entries(request)
+        stats["entries"] += len(result)
+        return web.json_response(result)
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    async def set_visible_until(request):
+        previous = state["visible_until"]
+        state["visible_until"] = int(request.query["t"])
+        if previous is not None and len(sockets) > 0:
+            update = {"delta": True, "lastUpdated": state["visible_until"]}
+            for collection, data in collections.items():
+                d = dates[collection]
+                update[collection + "s"] = [
+                    {
+                        "_id": f"{collection}{t}",
+                        "mills": t,
+                        "mgdl": v,
+                        "type": collection,
+                    }
+                    for t, v in data[
+                        bisect_right(d, previous) : bisect_right(
+                            d, state["visible_until"]
+                        )
+                    ]
+                ]
+            packet = "42" + json.dumps(["dataUpdate", update])
+            for ws in list(sockets):
+                await ws.send_str(packet)
+        return web.json_response({"result": "ok"})
+
+    async def fail(request):
+        state["failures"] = int(request.query["n"])
+        state["status"] = int(request.query.get("status", 503))
+        state["retry_after"] = request.query.get("retry_after")
+        return web.json_response({"result": "ok"})
+
+    async def socket(request):
+        # A minimal Engine.IO 4 / socket.io 5 server, which authorizes any client
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        stats["streams"] += 1
+        await ws.send_str('0{"sid":"emulator","pingInterval":1000,"pingTimeout":1000}')
+
+        async def ping():
+            while True:
+                await asyncio.sleep(1)
+                await ws.send_str("2")
+
+        pinger = asyncio.create_task(ping())
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                if msg.data == "40":
+                    await ws.send_str('40{"sid":"emulator"}')
+                elif msg.data.startswith("42"):
+                    ack = msg.data[2 : msg.data.index("[")]
+                    if json.loads(msg.data[2 + len(ack) :])[0] == "authorize":
+                        await ws.send_str(f'43{ack}[{{"read":true}}]')
+                        sockets.add(ws)
+        finally:
+            pinger.cancel()
+            sockets.discard(ws)
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/api/v1/entries/{collection}.json", get_entries)
+    app.router.add_get("/socket.io/", socket)
+    app.router.add_get("/_stats", get_stats)
+    app.router.add_post("/_visible_until", set_visible_until)
+    app.router.add_post("/_fail", fail)
+    return app
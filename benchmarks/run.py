@@ -0,0 +1,185 @@
+"""
+Offline benchmarks of the plugin's hot paths, run against a local Nightscout emulator and a fake heedy server:
+
+- backfill: first-time sync of a Nightscout server holding N years of data (all but the last day)
+- incremental: the following sync, once the last day of data has arrived
+- import: xDrip+ import of an N year database export
+
+For each, it reports the datapoints written, wall time, throughput, requests made to Nightscout and heedy,
+and the peak RSS of the process running it. Each benchmark runs in its own process, and the servers run in
+another, so that the RSS only counts the plugin code.
+
+    python benchmarks/run.py [--years 3] [--latency 0.02] [backfill] [incremental] [import]
+"""
+
+from multiprocessing import Process, Queue
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import fake_heedy
+import nightscout_emulator
+from synthetic import make_xdrip_db, nightscout_entries
+
+SCENARIOS = ["backfill", "incremental", "import"]
+ONE_DAY = 24 * 60 * 60
+
+
+def serve(years: float, latency: float, end_time: float, q: Queue):
+    from aiohttp import web
+
+    async def run():
+        sgv, mbg = nightscout_entries(years, end_time)
+        ports = []
+        for app in [
+            fake_heedy.make_app(),
+            nightscout_emulator.make_app({"sgv": sgv, "mbg": mbg}, latency),
+        ]:
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            ports.append(runner.addresses[0][1])
+        q.put(ports)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def request(url: str, method: str = "GET"):
+    with urllib.request.urlopen(urllib.request.Request(url, method=method)) as r:
+        return json.loads(r.read())
+
+
+async def sync(heedy_url: str, ns_url: str):
+    from heedy import App
+    from heedy.base import AsyncSession
+    from syncers.nightscout import sync_nightscout
+    from syncers.session import close_session
+
+    s = AsyncSession("cgm", heedy_url)
+    try:
+        app = App("nightscout", session=s)
+        return await sync_nightscout(
+            app,
+            logging.getLogger("benchmark"),
+            {"url": ns_url, "api_key": "benchmark", "service_type": "nightscout"},
+            {
+                # The emulator is local, so the plugin's throughput is measured rather than the rate limit
+                "requests_per_host_per_second": 0,
+                # The last day of data shows up after the backfill, as if it was uploaded late
+                "nightscout_settle_time": 2 * ONE_DAY,
+            },
+        )
+    finally:
+        await close_session()
+        await s.close()
+
+
+def xdrip(heedy_url: str, years: float, end_time: float):
+    from heedy import App
+    from heedy.base import SyncSession
+    from importers.xdrip import xdrip_import
+
+    with tempfile.TemporaryDirectory() as d:
+        db_file = os.path.join(d, "export.sqlite")
+        make_xdrip_db(db_file, years, end_time)
+        zip_file = os.path.join(d, "export.zip")
+        with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED) as z:
+            z.write(db_file, "export.sqlite")
+        os.remove(db_file)
+
+        app = App("xdrip", session=SyncSession("cgm", heedy_url))
+        start = time.perf_counter()
+        xdrip_import(
+            app, logging.getLogger("benchmark"), filename="export.zip", tmpfile=zip_file
+        )
+        return start
+
+
+def run_scenario(scenario: str, heedy_url: str, ns_url: str, args, q: Queue):
+    start = time.perf_counter()
+    if scenario == "import":
+        # The export is generated in this process, so only the import itself is timed
+        start = xdrip(heedy_url, args.years, args.end_time)
+    else:
+        asyncio.run(sync(heedy_url, ns_url))
+    duration = time.perf_counter() - start
+    q.put(
+        {
+            "wall": duration,
+            "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def measure(scenario: str, heedy_url: str, ns_url: str, args) -> dict:
+    heedy_before = request(heedy_url + "/_stats")
+    ns_before = request(ns_url + "/_stats")
+
+    q = Queue()
+    p = Process(target=run_scenario, args=(scenario, heedy_url, ns_url, args, q))
+    p.start()
+    result = q.get()
+    p.join()
+
+    heedy_after = request(heedy_url + "/_stats")
+    ns_after = request(ns_url + "/_stats")
+    result["points"] = heedy_after["inserted"] - heedy_before["inserted"]
+    result["ns_requests"] = ns_after["requests"] - ns_before["requests"]
+    result["heedy_requests"] = heedy_after["requests"] - heedy_before["requests"] - 1
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds added to each Nightscout request",
+    )
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    args = parser.parse_args()
+    if len(args.scenarios) == 0:
+        args.scenarios = SCENARIOS
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+    args.end_time = time.time()
+    logging.basicConfig(level=logging.WARNING)
+
+    q = Queue()
+    server = Process(target=serve, args=(args.years, args.latency, args.end_time, q))
+    server.daemon = True
+    server.start()
+    heedy_port, ns_port = q.get()
+    heedy_url = f"http://127.0.0.1:{heedy_port}"
+    ns_url = f"http://127.0.0.1:{ns_port}"
+
+    # The backfill sees all but the last day of data, which then arrives for the incremental sync
+    request(
+        f"{ns_url}/_visible_until?t={int((args.end_time - ONE_DAY) * 1000)}", "POST"
+    )
+
+    print(
+        f"{'scenario':>12} {'points':>9} {'wall (s)':>9} {'points/s':>10} {'NS reqs':>8} {'heedy reqs':>11} {'RSS (MB)':>9}"
+    )
+    for scenario in args.scenarios:
+        if scenario == "incremental":
+            request(f"{ns_url}/_visible_until?t={int(args.end_time * 1000)}", "POST")
+        r = measure(scenario, heedy_url, ns_url, args)
+        print(
+            f"{scenario:>12} {r['points']:>9} {r['wall']:>9.2f} {r['points'] / r['wall']:>10,.0f} {r['ns_requests']:>8} {r['heedy_requests']:>11} {r['rss']:>9.1f}"
+        )
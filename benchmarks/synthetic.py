@@ -0,0 +1,98 @@
+"""
+Generators of synthetic CGM data used by the benchmarks
+"""
+
+import math
+import random
+import sqlite3
+import time
+
+READING_INTERVAL = 5 * 60
+SENSOR_DURATION = 10 * 24 * 60 * 60
+
+
+def glucose(t: float) -> float:
+    # A daily cycle with noise, in mg/dL
+    return 130 + 50 * math.sin(2 * math.pi * t / (24 * 60 * 60)) + random.gauss(0, 15)
+
+
+def make_xdrip_db(filename: str, years: float, end_time: float = None, seed: int = 0):
+    """
+    Creates an sqlite database with the tables and columns of an xDrip+ export that are read by the
+    importer, holding a reading every 5 minutes, a finger-stick test a few times a day,
+    and a sensor start every 10 days.
+    """
+    random.seed(seed)
+    if end_time is None:
+        end_time = time.time()
+    start_time = end_time - years * 365 * 24 * 60 * 60
+
+    db = sqlite3.connect(filename)
+    db.execute(
+        "CREATE TABLE BgReadings (_id INTEGER PRIMARY KEY, timestamp INTEGER, calculated_value REAL)"
+    )
+    db.execute("CREATE INDEX BgReadings_timestamp ON BgReadings (timestamp)")
+    db.execute(
+        "CREATE TABLE BloodTest (_id INTEGER PRIMARY KEY, timestamp INTEGER, mgdl REAL)"
+    )
+    db.execute("CREATE INDEX BloodTest_timestamp ON BloodTest (timestamp)")
+    db.execute("CREATE TABLE Sensors (_id INTEGER PRIMARY KEY, started_at INTEGER)")
+
+    n = int((end_time - start_time) / READING_INTERVAL)
+    db.executemany(
+        "INSERT INTO BgReadings (timestamp, calculated_value) VALUES (?, ?)",
+        (
+            (
+                int((start_time + i * READING_INTERVAL) * 1000),
+                glucose(start_time + i * READING_INTERVAL),
+            )
+            for i in range(n)
+        ),
+    )
+    db.executemany(
+        "INSERT INTO BloodTest (timestamp, mgdl) VALUES (?, ?)",
+        (
+            (
+                int((start_time + i * 8 * 60 * 60) * 1000),
+                glucose(start_time + i * 8 * 60 * 60),
+            )
+            for i in range(int((end_time - start_time) / (8 * 60 * 60)))
+        ),
+    )
+    db.executemany(
+        "INSERT INTO Sensors (started_at) VALUES (?)",
+        (
+            (int((start_time + i * SENSOR_DURATION) * 1000),)
+            for i in range(int((end_time - start_time) / SENSOR_DURATION))
+        ),
+    )
+    db.commit()
+    db.close()
+    return n
+
+
+def nightscout_entries(years: float, end_time: float = None, seed: int = 0):
+    """
+    Returns the sgv and mbg collections of a synthetic Nightscout server as sorted lists of
+    (millisecond timestamp, value) tuples, with an sgv entry every 5 minutes and an mbg entry
+    every 8 hours.
+    """
+    random.seed(seed)
+    if end_time is None:
+        end_time = time.time()
+    start_time = end_time - years * 365 * 24 * 60 * 60
+    sgv = [
+        (int(t * 1000), round(glucose(t)))
+        for t in (
+            start_time + i * READING_INTERVAL
+            for i in range(int((end_time - start_time) / READING_INTERVAL))
+        )
+    ]
+    mbg = [
+        (int(t * 1000), round(glucose(t)))
+        for t in (
+            start_time + i * 8 * 60 * 60
+            for i in range(int((end_time - start_time) / (8 * 60 * 60)))
+        )
+    ]
+    return sgv, mbg
@@ -0,0 +1,59 @@
+"""
+Compares the rate at which xdrip_import converts database rows into the JSON sent to heedy's insert_array,
+between per-point dicts (the original implementation) and batches encoded by sqlite (importers/bulk.py).
+
+    python benchmarks/xdrip_batches.py [years]
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from importers.bulk import json_batches
+from importers.xdrip import xdrip_queries
+from synthetic import make_xdrip_db
+
+batch_size = 100000
+
+
+def dict_batches(c, query):
+    c.execute(query + " ORDER BY t ASC", (0,))
+    data = c.fetchmany(batch_size)
+    while len(data) > 0:
+        data = list(map(lambda x: {"t": x[0] / 1000, "d": x[1]}, data))
+        yield json.dumps(data), len(data)
+        data = c.fetchmany(batch_size)
+
+
+def columnar_batches(c, query):
+    for data, count, _ in json_batches(c, query, 0, batch_size):
+        yield data, count
+
+
+def measure(c, batches):
+    rows = 0
+    start = time.perf_counter()
+    for _, query in xdrip_queries:
+        for _, count in batches(c, query):
+            rows += count
+    return rows, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    years = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, "export.sqlite")
+        make_xdrip_db(filename, years)
+        db = sqlite3.connect(filename)
+        c = db.cursor()
+        for name, batches in [("dicts", dict_batches), ("columnar", columnar_batches)]:
+            rows, duration = measure(c, batches)
+            print(
+                f"{name:>10}: {rows} rows in {duration:.2f}s ({rows / duration:,.0f} rows/s)"
+            )
+        db.close()